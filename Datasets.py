@@ -1,10 +1,11 @@
 from argparse import Namespace
 import torch
 import numpy as np
-import pickle, os, logging
-from typing import Dict, List
+import pickle, os, logging, hashlib, shutil
+from typing import Dict, List, Optional
 
-from Pattern_Generator import Text_Filtering, Decompose
+from Pattern_Generator import Text_Filtering, Decompose, Pattern_Load, Pattern_Load_Size
+from Pattern_Store import Pattern_Store
 
 def Text_to_Token(text, token_dict):
     return np.array([
@@ -49,7 +50,9 @@ class Dataset(torch.utils.data.Dataset):
         text_length_min: int,
         text_length_max: int,
         accumulated_dataset_epoch: int= 1,
-        augmentation_ratio: float= 0.0
+        augmentation_ratio: float= 0.0,
+        store_path: Optional[str]= None,
+        pattern_cache: Optional['Pattern_Cache']= None
         ):
         super().__init__()
         self.token_dict = token_dict
@@ -57,6 +60,8 @@ class Dataset(torch.utils.data.Dataset):
         self.feature_max = max([value['Max'] for value in feature_range_info_dict.values()])
         self.feature_type = feature_type
         self.pattern_path = pattern_path
+        self.pattern_store = Pattern_Store(store_path) if not store_path is None else None
+        self.pattern_cache = pattern_cache
         
         if feature_type == 'Mel':
             feature_length_dict = 'Mel_Length_Dict'
@@ -87,20 +92,68 @@ class Dataset(torch.utils.data.Dataset):
                 metadata_dict['Text_Length_Dict'][x] <= text_length_max
                 ])
             ] * accumulated_dataset_epoch
+        self.feature_lengths = [metadata_dict[feature_length_dict][x] for x in self.patterns]
+        self.pattern_keys = sorted(set(self.patterns))
+        self.pattern_key_index_dict = {key: index for index, key in enumerate(self.pattern_keys)}
 
     def __getitem__(self, idx):
-        path = os.path.join(self.pattern_path, self.patterns[idx]).replace('\\', '/')
-        pattern_dict = pickle.load(open(path, 'rb'))
+        key = self.patterns[idx]
+        if not self.pattern_cache is None:
+            cached = self.pattern_cache.Get(key)
+            if not cached is None:
+                token, feature = cached
+                return token, feature, self.pattern_key_index_dict[key]
+
+        if not self.pattern_store is None:
+            feature = self.pattern_store.Get(key, self.feature_type)
+            if self.pattern_store.Has_Value('Token'):
+                token = self.pattern_store.Get_Value(key, 'Token')
+            else:
+                token = Text_to_Token(self.pattern_store.Get_Value(key, 'Decomposed'), self.token_dict)
+
+            store_normalization = self.pattern_store.Get_Normalization(self.feature_type)
+            if store_normalization == (self.feature_min, self.feature_max):
+                return token, feature, self.pattern_key_index_dict[key]   # Pre-normalized by the current range info.
+            elif not store_normalization is None:
+                store_min, store_max = store_normalization
+                feature = (feature + 1.0) / 2.0 * (store_max - store_min) + store_min # The range info is changed after the store generation.
+        else:
+            path = os.path.join(self.pattern_path, key).replace('\\', '/')
+            pattern_dict = Pattern_Load(path, keys= ['Token', 'Decomposed', self.feature_type])
+            if 'Token' in pattern_dict:
+                token = pattern_dict['Token']
+            else:
+                token = Text_to_Token(pattern_dict['Decomposed'], self.token_dict)
+            feature = pattern_dict[self.feature_type]
         
-        token = Text_to_Token(pattern_dict['Decomposed'], self.token_dict)
-        feature = pattern_dict[self.feature_type]
+        feature = np.asarray(feature, dtype= np.float32)   # The pattern files are stored raw, so they are normalized at every read.
         feature = (feature - self.feature_min) / (self.feature_max - self.feature_min) * 2.0 - 1.0
 
-        return token, feature
+        if not self.pattern_cache is None:
+            self.pattern_cache.Set(key, token, feature)
+
+        return token, feature, self.pattern_key_index_dict[key]
 
     def __len__(self):
         return len(self.patterns)
 
+    def IO_Report(self, sample_count: int= 100):
+        '''
+        Returns the average bytes per sample of the whole pattern files and of the part which __getitem__ reads.
+        Only the file headers are read.
+        '''
+        if not self.pattern_store is None or len(self.patterns) == 0:
+            return None, None
+
+        paths = [
+            os.path.join(self.pattern_path, pattern).replace('\\', '/')
+            for pattern in self.patterns[::max(1, len(self.patterns) // sample_count)][:sample_count]
+            ]
+        whole_size = np.mean([Pattern_Load_Size(path) for path in paths])
+        loaded_size = np.mean([Pattern_Load_Size(path, keys= ['Token', 'Decomposed', self.feature_type]) for path in paths])
+
+        return whole_size, loaded_size
+
 class Inference_Dataset(torch.utils.data.Dataset):
     def __init__(
         self,
@@ -130,6 +183,265 @@ class Inference_Dataset(torch.utils.data.Dataset):
         return len(self.patterns)
 
 
+class Pattern_Cache:
+    '''
+    A file cache of the tokens and the normalized features in a tmpfs like /dev/shm.
+    The files are shared by all DataLoader workers and DDP ranks of a node, and a feature is read by memory map.
+    Each file is written to a temporary name and renamed, so a reader never sees a partial file.
+    When the cache is larger than max_bytes, the least recently used patterns are evicted by the modified time which Get updates.
+    min_free_ratio of the file system is always left free, because DataLoader also uses /dev/shm to send the batches.
+    A pattern which cannot be written is just not cached.
+    '''
+    def __init__(
+        self,
+        path: str,
+        namespace: str,
+        max_bytes: int,
+        check_interval: int= 32,
+        min_free_ratio: float= 0.25
+        ):
+        self.path = path
+        self.namespace = namespace
+        self.max_bytes = max_bytes
+        self.check_interval = check_interval
+        self.min_free_ratio = min_free_ratio
+        self.set_count = 0
+        self.set_bytes = 0  # Written by this process after the last check.
+        os.makedirs(path, exist_ok= True)
+
+    def File_Path(self, key: str):
+        name = hashlib.md5('{}/{}'.format(self.namespace, key).encode('utf-8')).hexdigest().upper()
+        return os.path.join(self.path, name).replace('\\', '/')
+
+    def Get(self, key: str):
+        path = self.File_Path(key)
+        try:
+            token = np.load(path + '.TOKEN.NPY')
+            feature = np.load(path + '.FEATURE.NPY', mmap_mode= 'r')
+            os.utime(path + '.FEATURE.NPY')
+        except (OSError, ValueError):  # Not cached or evicted by the other process.
+            return None
+
+        return token, feature
+
+    def Free_Bytes(self):
+        usage = shutil.disk_usage(self.path)
+        return usage.free - int(usage.total * self.min_free_ratio)
+
+    def Set(self, key: str, token: np.ndarray, feature: np.ndarray):
+        nbytes = token.nbytes + feature.nbytes + 256    # 256: the npy headers.
+        self.set_count += 1
+        if self.set_count % self.check_interval == 0 or \
+            self.set_bytes + nbytes > self.max_bytes // self.check_interval or \
+            self.Free_Bytes() < nbytes:
+            self.Evict(nbytes)
+            self.set_bytes = 0
+        if self.Free_Bytes() < nbytes:
+            return  # The file system is still full.
+
+        path = self.File_Path(key)
+        for suffix, value in [('.TOKEN.NPY', token), ('.FEATURE.NPY', feature)]:
+            temp_path = '{}{}.{}.TMP'.format(path, suffix, os.getpid())
+            try:
+                with open(temp_path, 'wb') as f:
+                    np.save(f, value)
+                os.replace(temp_path, path + suffix)
+            except OSError:    # e.g. ENOSPC by the other processes.
+                for file_path in [temp_path, path + '.TOKEN.NPY']:
+                    try:
+                        os.remove(file_path)
+                    except OSError:
+                        pass
+                return
+        self.set_bytes += nbytes
+
+    def Evict(self, required_bytes: int= 0):
+        '''
+        Evicts the least recently used patterns until the cache is under max_bytes
+        and required_bytes can be written without going under the free space limit.
+        '''
+        entries = []
+        for entry in os.scandir(self.path):
+            if not entry.name.endswith('.NPY'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, entry.path, stat.st_size))
+
+        total_bytes = sum([size for _, _, size in entries])
+        limit_bytes = min(self.max_bytes, total_bytes + self.Free_Bytes() - required_bytes)
+        if total_bytes <= limit_bytes:
+            return
+
+        for _, path, _ in sorted([entry for entry in entries if entry[1].endswith('.FEATURE.NPY')]):
+            if total_bytes <= limit_bytes * 0.9:    # Evict some more not to scan at every check.
+                break
+            for file_path in [path, path[:-len('.FEATURE.NPY')] + '.TOKEN.NPY']:
+                try:
+                    total_bytes -= os.path.getsize(file_path)
+                    os.remove(file_path)
+                except FileNotFoundError:
+                    pass
+
+class Duration_Cache:
+    '''
+    The alignment durations of the patterns in memory-mapped arrays, [Pattern, Max_Token_t] and the searched step of each pattern.
+    A duration is reused until refresh_interval steps passed from its searched step.
+    The arrays are regenerated when the pattern keys or max_token_length are changed.
+    A pattern longer than max_token_length is not cached.
+    '''
+    def __init__(
+        self,
+        path: str,
+        pattern_keys: List[str],
+        max_token_length: int,
+        refresh_interval: int
+        ):
+        os.makedirs(path, exist_ok= True)
+        self.refresh_interval = refresh_interval
+
+        key_path = os.path.join(path, 'KEYS.PICKLE').replace('\\', '/')
+        key_dict = {'Pattern_Keys': pattern_keys, 'Max_Token_Length': max_token_length}
+        mode = 'r+'
+        if not os.path.exists(key_path) or pickle.load(open(key_path, 'rb')) != key_dict:
+            mode = 'w+'
+            pickle.dump(key_dict, open(key_path, 'wb'), protocol= 4)
+
+        durations_path = os.path.join(path, 'DURATIONS.NPY').replace('\\', '/')
+        steps_path = os.path.join(path, 'STEPS.NPY').replace('\\', '/')
+        if mode == 'r+':
+            try:
+                self.durations = np.lib.format.open_memmap(durations_path, mode= 'r+')
+                self.steps = np.lib.format.open_memmap(steps_path, mode= 'r+')
+                if any([
+                    self.durations.shape != (len(pattern_keys), max_token_length),
+                    self.durations.dtype != np.int16,
+                    self.steps.shape != (len(pattern_keys),),
+                    self.steps.dtype != np.int64
+                    ]):
+                    mode = 'w+'
+            except (OSError, ValueError):   # Missing, or the headerless files of an older version.
+                mode = 'w+'
+        if mode == 'w+':
+            self.durations = np.lib.format.open_memmap(
+                durations_path,
+                mode= 'w+',
+                dtype= np.int16,
+                shape= (len(pattern_keys), max_token_length)
+                )
+            self.steps = np.lib.format.open_memmap(
+                steps_path,
+                mode= 'w+',
+                dtype= np.int64,
+                shape= (len(pattern_keys),)
+                )
+            self.steps[:] = -1
+
+    def Get(self, indices: np.ndarray, step: int, token_length: int):
+        '''
+        indices: [Batch], the pattern key indices.
+        Returns the cached durations [Batch, Token_t] when every pattern of the batch is fresh. Otherwise, None.
+        '''
+        steps = self.steps[indices]
+        if (steps < 0).any() or (step - steps >= self.refresh_interval).any():
+            return None
+
+        durations = self.durations[indices, :token_length].astype(np.int64)
+
+        return np.pad(durations, [[0, 0], [0, token_length - durations.shape[1]]])
+
+    def Set(self, indices: np.ndarray, durations: np.ndarray, step: int):
+        '''
+        indices: [Batch], the pattern key indices.
+        durations: [Batch, Token_t]
+        '''
+        max_token_length = self.durations.shape[1]
+        cachables = ~(durations[:, max_token_length:] > 0).any(axis= 1)
+        indices, durations = indices[cachables], durations[cachables, :max_token_length]
+
+        self.durations[indices, :durations.shape[1]] = durations
+        self.durations[indices, durations.shape[1]:] = 0
+        self.steps[indices] = step
+
+    def Flush(self):
+        self.durations.flush()
+        self.steps.flush()
+
+class Bucket_Batch_Sampler(torch.utils.data.Sampler):
+    '''
+    The batches of the patterns with similar lengths.
+    At each epoch, the indices are shuffled and split to the pools of pool_size batches, and each pool is sorted by the length.
+    A sorted pool is cut into the batches of at most batch_size patterns whose padded frames (the longest length * the number of patterns)
+    are in frame_budget. The order of the batches is shuffled.
+    In DDP, every rank makes the same batches from the same seed and takes only the batches of its rank.
+    '''
+    def __init__(
+        self,
+        lengths: List[int],
+        batch_size: int,
+        frame_budget: Optional[int]= None,
+        pool_size: int= 100,
+        shuffle: bool= True,
+        num_replicas: int= 1,
+        rank: int= 0,
+        seed: int= 0
+        ):
+        self.lengths = np.array(lengths)
+        self.batch_size = batch_size
+        self.frame_budget = frame_budget
+        self.pool_size = pool_size
+        self.shuffle = shuffle
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.batches = None
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+        self.batches = None
+
+    def Batches(self):
+        if not self.batches is None:
+            return self.batches
+
+        random_state = np.random.RandomState(self.seed + self.epoch)
+        indices = random_state.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+
+        batches = []
+        pool_length = self.pool_size * self.batch_size
+        for pool_start in range(0, len(indices), pool_length):
+            pool = indices[pool_start:pool_start + pool_length]
+            pool = pool[np.argsort(self.lengths[pool], kind= 'stable')]
+            batch = []
+            for index in pool.tolist():
+                if len(batch) > 0 and (
+                    len(batch) == self.batch_size or
+                    (not self.frame_budget is None and (len(batch) + 1) * self.lengths[index] > self.frame_budget)
+                    ):
+                    batches.append(batch)
+                    batch = []
+                batch.append(index)
+            if len(batch) > 0:
+                batches.append(batch)
+
+        if self.shuffle:
+            batches = [batches[index] for index in random_state.permutation(len(batches))]
+        if self.num_replicas > 1:
+            batches = batches[:len(batches) // self.num_replicas * self.num_replicas]   # Same number of steps in every rank.
+            batches = batches[self.rank::self.num_replicas]
+
+        self.batches = batches
+        return self.batches
+
+    def __iter__(self):
+        return iter(self.Batches())
+
+    def __len__(self):
+        return len(self.Batches())
+
 class Collater:
     def __init__(
         self,
@@ -138,7 +450,7 @@ class Collater:
         self.token_dict = token_dict
 
     def __call__(self, batch):
-        tokens, features = zip(*batch)
+        tokens, features, pattern_indices = zip(*batch)
         token_lengths = np.array([token.shape[0] for token in tokens])
         feature_lengths = np.array([feature.shape[0] for feature in features])
 
@@ -149,8 +461,9 @@ class Collater:
         token_lengths = torch.LongTensor(token_lengths)   # [Batch]
         features = torch.FloatTensor(features).permute(0, 2, 1)   # [Batch, Feature_d, Featpure_t]
         feature_lengths = torch.LongTensor(feature_lengths)   # [Batch]
+        pattern_indices = torch.LongTensor(pattern_indices)   # [Batch]
 
-        return tokens, token_lengths, features, feature_lengths
+        return tokens, token_lengths, features, feature_lengths, pattern_indices
 
 class Inference_Collater:
     def __init__(self,
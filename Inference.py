@@ -0,0 +1,410 @@
+import os
+os.environ['FOR_DISABLE_CONSOLE_CTRL_HANDLER'] = 'T'    # This is ot prevent to be called Fortran Ctrl+C crash in Windows.
+import torch
+import numpy as np
+import logging, yaml, sys, argparse, time
+from collections import defaultdict
+from typing import Dict, List, Optional
+from librosa import griffinlim
+from scipy.io import wavfile
+
+from Modules.Modules import GradTTS, Mask_Generate
+
+from Datasets import Text_to_Token, Token_Stack
+from Pattern_Generator import Text_Filtering, Decompose
+from meldataset import spectral_de_normalize_torch
+from Arg_Parser import Recursive_Parse
+
+logging.basicConfig(
+    level=logging.INFO, stream=sys.stdout,
+    format= '%(asctime)s (%(module)s:%(lineno)d) %(levelname)s: %(message)s'
+    )
+
+class Inferencer:
+    '''
+    Synthesis without the training state of Trainer.
+    Only the 'Model' state of a checkpoint is loaded. No dataloader, optimizer, logger or plot is generated.
+    '''
+    stages = ['Encoder', 'Duration', 'Length_Regulation', 'Diffusion', 'Vocoder']
+
+    def __init__(
+        self,
+        hp_path: str,
+        checkpoint_path: str,
+        vocoder_path: Optional[str]= 'hifigan_ptransdifftts_exp12_500k.pts',
+        batch_size: Optional[int]= None,
+        frame_budget: Optional[int]= None,
+        sampler: Optional[str]= None,
+        sampling_steps: Optional[int]= None,
+        eta: Optional[float]= None,
+        temperature: Optional[float]= None
+        ):
+        self.hp_path = hp_path
+        self.hp = Recursive_Parse(yaml.load(
+            open(self.hp_path, encoding='utf-8'),
+            Loader=yaml.Loader
+            ))
+
+        if not torch.cuda.is_available():
+            self.device = torch.device('cpu')
+        else:
+            self.device = torch.device('cuda:0')
+            torch.backends.cudnn.enabled = True
+            torch.backends.cudnn.benchmark = False
+
+        self.batch_size = batch_size or self.hp.Inference_Batch_Size or self.hp.Train.Batch_Size
+        self.frame_budget = frame_budget or self.hp.Inference_Frame_Budget
+        self.sampling_dict = {
+            'sampler': sampler,
+            'sampling_steps': sampling_steps,
+            'eta': eta,
+            'temperature': temperature
+            }   # None follows 'Diffusion.Sampling' of the hyper parameters.
+
+        self.token_dict = yaml.load(open(self.hp.Token_Path), Loader=yaml.Loader)
+        if self.hp.Feature_Type == 'Spectrogram':
+            feature_range_info_dict = yaml.load(open(self.hp.Spectrogram_Range_Info_Path), Loader=yaml.Loader)
+        if self.hp.Feature_Type == 'Mel':
+            feature_range_info_dict = yaml.load(open(self.hp.Mel_Range_Info_Path), Loader=yaml.Loader)
+        self.feature_min = min([value['Min'] for value in feature_range_info_dict.values()])
+        self.feature_max = max([value['Max'] for value in feature_range_info_dict.values()])
+
+        self.Model_Generate(vocoder_path= vocoder_path)
+        self.Load_Checkpoint(checkpoint_path= checkpoint_path)
+
+    def Model_Generate(self, vocoder_path: Optional[str]= None):
+        self.model = GradTTS(self.hp).to(self.device)
+        self.model.eval()
+
+        self.vocoder = None
+        if self.hp.Feature_Type == 'Mel' and not vocoder_path is None:
+            self.vocoder = torch.jit.load(vocoder_path, map_location='cpu').to(self.device)
+            self.vocoder.eval()
+
+    def Load_Checkpoint(self, checkpoint_path: str):
+        state_dict = torch.load(checkpoint_path, map_location= 'cpu')
+        self.model.load_state_dict(state_dict['Model'])
+        self.steps = state_dict['Steps']
+
+        logging.info('Checkpoint loaded at {} steps.'.format(self.steps))
+
+    def Synchronize(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    def Text_to_Pattern(self, texts: List[str]):
+        tokens, valid_indices = [], []
+        for index, text in enumerate(texts):
+            text = Text_Filtering(text)
+            if text is None or text == '':
+                logging.warning('The text of index {} is incorrect. This index is ignoired.'.format(index))
+                continue
+            tokens.append(Text_to_Token(Decompose(text), self.token_dict))
+            valid_indices.append(index)
+
+        return tokens, valid_indices
+
+    def Encode(
+        self,
+        tokens: torch.Tensor,
+        token_lengths: torch.Tensor,
+        timing_dict: Dict[str, float]
+        ):
+        '''
+        tokens: [Batch, Token_t]
+        token_lengths: [Batch]
+        Returns the encodings [Batch, Enc_d, Token_t] and the predicted durations [Batch, Token_t].
+        '''
+        tokens = tokens.to(self.device, non_blocking=True)
+        token_lengths = token_lengths.to(self.device, non_blocking=True)
+
+        start_time = time.perf_counter()
+        encodings, _, _, _ = self.model.encoder(tokens, token_lengths)   # [Batch, Enc_d, Token_t]
+        self.Synchronize()
+        timing_dict['Encoder'] += time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        log_duration_predictions = self.model.variance_predictor_block.duration_predictor(encodings).squeeze(1)   # [Batch, Token_t]
+        token_masks = ~Mask_Generate(lengths= token_lengths, max_length= tokens.size(1))
+        durations = (log_duration_predictions.exp() - 1).clip(0, 50).ceil().long() * token_masks   # Padding tokens are not expanded.
+        self.Synchronize()
+        timing_dict['Duration'] += time.perf_counter() - start_time
+
+        return encodings, durations
+
+    def Length_Regulate(
+        self,
+        encodings: torch.Tensor,
+        durations: torch.Tensor,
+        timing_dict: Dict[str, float]
+        ):
+        start_time = time.perf_counter()
+        encodings = self.model.variance_predictor_block.length_regulator(
+            encodings= encodings,
+            durations= durations
+            )   # [Batch, Enc_d, Feature_t]
+        self.Synchronize()
+        timing_dict['Length_Regulation'] += time.perf_counter() - start_time
+
+        return encodings
+
+    def Diffuse(
+        self,
+        conditions: torch.Tensor,
+        timing_dict: Dict[str, float]
+        ):
+        '''
+        conditions: [Batch, Enc_d, Feature_t]
+        Returns the de-normalized features [Batch, Feature_d, Feature_t].
+        '''
+        start_time = time.perf_counter()
+        features, _, _ = self.model.diffusion(
+            conditions= conditions,
+            **self.sampling_dict
+            )
+        features = features.clamp(-1.0, 1.0)
+        features = (features + 1.0) / 2.0 * (self.feature_max - self.feature_min) + self.feature_min
+        self.Synchronize()
+        timing_dict['Diffusion'] += time.perf_counter() - start_time
+
+        return features
+
+    def Decode(
+        self,
+        encodings: torch.Tensor,
+        durations: torch.Tensor,
+        timing_dict: Dict[str, float]
+        ):
+        '''
+        encodings: [Batch, Enc_d, Token_t]
+        durations: [Batch, Token_t], zero at the padding tokens.
+        '''
+        feature_lengths = durations.sum(dim= 1)   # [Batch]
+        encodings = self.Length_Regulate(encodings, durations, timing_dict)
+        features = self.Diffuse(encodings, timing_dict)
+
+        start_time = time.perf_counter()
+        feature_lengths = feature_lengths.cpu().tolist()
+        features_list = [
+            feature[:, :length].cpu().numpy()
+            for feature, length in zip(features, feature_lengths)
+            ]
+        audios = self.Vocode(features, feature_lengths)
+        self.Synchronize()
+        timing_dict['Vocoder'] += time.perf_counter() - start_time
+
+        return features_list, audios
+
+    @torch.no_grad()
+    def Stream(
+        self,
+        text: str,
+        chunk_size: Optional[int]= None,
+        timing_dict: Optional[Dict[str, float]]= None
+        ):
+        '''
+        text: a raw text.
+        Yields the audio chunks of the text as soon as each chunk is vocoded.
+        The encoder and the duration predictor run once. The diffusion runs on the chunks of chunk_size frames
+        with 'Streaming.Diffusion_Margin' context frames at both sides, and the vocoder runs on each chunk
+        with 'Streaming.Vocoder_Margin' context frames. Neighbouring audio chunks are cross-faded.
+        timing_dict gets 'First_Chunk', the latency to the first audio chunk in seconds.
+        '''
+        assert self.hp.Feature_Type == 'Mel' and not self.vocoder is None, \
+            'Streaming requires the mel vocoder. Griffin-Lim normalizes the peak of each call, so the chunks would get different gains.'
+        timing_dict = timing_dict if not timing_dict is None else defaultdict(float)
+        start_time = time.perf_counter()
+
+        chunk_size = chunk_size or self.hp.Streaming.Chunk_Size
+        diffusion_margin = self.hp.Streaming.Diffusion_Margin
+        vocoder_margin = min(self.hp.Streaming.Vocoder_Margin, diffusion_margin)
+        crossfade = min(self.hp.Streaming.Crossfade, vocoder_margin * self.hp.Sound.Frame_Shift)
+
+        tokens, _ = self.Text_to_Pattern([text])
+        if len(tokens) == 0:
+            return
+        token_lengths = torch.LongTensor([tokens[0].shape[0]])  # [1]
+        tokens = torch.LongTensor(tokens[0]).unsqueeze(0)   # [1, Token_t]
+
+        encodings, durations = self.Encode(tokens, token_lengths, timing_dict)
+        conditions = self.Length_Regulate(encodings, durations, timing_dict)  # [1, Enc_d, Feature_t]
+        feature_length = conditions.size(2)
+
+        history, tail = None, None
+        for chunk_start in range(0, feature_length, chunk_size):
+            chunk_end = min(chunk_start + chunk_size, feature_length)
+            diffusion_start = max(chunk_start - diffusion_margin, 0)
+            diffusion_end = min(chunk_end + diffusion_margin, feature_length)
+
+            features = self.Diffuse(conditions[:, :, diffusion_start:diffusion_end], timing_dict)   # [1, Feature_d, Diffusion_t]
+            core_features = features[:, :, chunk_start - diffusion_start:chunk_end - diffusion_start]
+            lookahead_features = features[:, :, chunk_end - diffusion_start:chunk_end - diffusion_start + vocoder_margin]   # Replaced by the next chunk later.
+
+            vocoding_start_time = time.perf_counter()
+            history = history[:, :, max(history.size(2) - vocoder_margin, 0):] if not history is None else core_features[:, :, :0]  # Not [-0:], which is the whole history.
+            vocoder_features = torch.cat([history, core_features, lookahead_features], dim= 2)
+            audio = self.Vocode(vocoder_features, [vocoder_features.size(2)])[0]
+            audio = audio[history.shape[2] * self.hp.Sound.Frame_Shift:]   # Starts at chunk_start.
+            history = torch.cat([history, core_features], dim= 2)
+
+            if not tail is None:
+                fade_length = min(tail.shape[0], audio.shape[0])
+                fade = np.linspace(0.0, 1.0, fade_length, dtype= audio.dtype)
+                audio[:fade_length] = tail[:fade_length] * (1.0 - fade) + audio[:fade_length] * fade
+            if chunk_end < feature_length:
+                core_length = (chunk_end - chunk_start) * self.hp.Sound.Frame_Shift
+                tail = audio[core_length:core_length + crossfade].copy()
+                audio = audio[:core_length]
+            self.Synchronize()
+            timing_dict['Vocoder'] += time.perf_counter() - vocoding_start_time
+
+            if chunk_start == 0:
+                timing_dict['First_Chunk'] = time.perf_counter() - start_time
+                logging.info('First chunk latency: {:.3f} sec'.format(timing_dict['First_Chunk']))
+
+            yield audio
+
+    def Vocode(self, features: torch.Tensor, feature_lengths: List[int]):
+        '''
+        features: [Batch, Feature_d, Feature_t], de-normalized
+        Returns the audios in [-1, 1].
+        '''
+        if self.hp.Feature_Type == 'Mel':
+            if self.vocoder is None:
+                return [None] * features.size(0)
+            return [
+                audio[:min(length * self.hp.Sound.Frame_Shift, audio.size(0))].cpu().numpy() / 32768.0  # The vocoder returns the int16 scale.
+                for audio, length in zip(
+                    self.vocoder(features),
+                    feature_lengths
+                    )
+                ]
+        elif self.hp.Feature_Type == 'Spectrogram':
+            audios = []
+            for feature, length in zip(features, feature_lengths):
+                feature = spectral_de_normalize_torch(feature[:, :length]).cpu().numpy()
+                audio = griffinlim(feature)[:length * self.hp.Sound.Frame_Shift]
+                audio = audio / np.abs(audio).max()
+                audios.append(audio)
+            return audios
+
+    def Schedule(self, feature_lengths: List[int]):
+        '''
+        feature_lengths: the predicted feature length of each pattern.
+        Returns the index lists of the batches. The patterns are grouped by the length,
+        and the padded frames of a batch (the longest length * the batch size) are kept in the frame budget.
+        A pattern longer than the budget becomes a batch alone.
+        '''
+        batches, batch = [], []
+        for index in sorted(range(len(feature_lengths)), key= lambda x: feature_lengths[x]):
+            if len(batch) > 0 and (len(batch) + 1) * feature_lengths[index] > self.frame_budget:
+                batches.append(batch)
+                batch = []
+            batch.append(index)
+        if len(batch) > 0:
+            batches.append(batch)
+
+        return batches
+
+    @torch.no_grad()
+    def Inference(self, texts: List[str]):
+        '''
+        texts: raw texts. Returns the features, audios in the order of texts and the timing of each stage in seconds.
+        The feature and audio of an incorrect text are None.
+        The encoder and the duration predictor run on the batches of batch_size sorted by the token length.
+        The rest stages run on the batches scheduled by the predicted feature length under the frame budget.
+        '''
+        tokens, valid_indices = self.Text_to_Pattern(texts)
+        timing_dict = defaultdict(float)
+
+        encodings_list, durations_list, feature_lengths = [None] * len(tokens), [None] * len(tokens), [None] * len(tokens)
+        token_orders = sorted(range(len(tokens)), key= lambda x: tokens[x].shape[0])
+        for start_index in range(0, len(tokens), self.batch_size):
+            batch_indices = token_orders[start_index:start_index + self.batch_size]
+            batch_tokens = [tokens[index] for index in batch_indices]
+            token_lengths = torch.LongTensor([token.shape[0] for token in batch_tokens])   # [Batch]
+            batch_tokens = torch.LongTensor(Token_Stack(batch_tokens, self.token_dict))   # [Batch, Token_t]
+
+            encodings, durations = self.Encode(batch_tokens, token_lengths, timing_dict)
+            for index, encoding, duration, token_length, feature_length in zip(
+                batch_indices,
+                encodings,
+                durations,
+                token_lengths.tolist(),
+                durations.sum(dim= 1).cpu().tolist()
+                ):
+                encodings_list[index] = encoding[:, :token_length]    # [Enc_d, Token_t]
+                durations_list[index] = duration[:token_length]    # [Token_t]
+                feature_lengths[index] = feature_length
+
+        features_list, audios = [None] * len(texts), [None] * len(texts)
+        for batch_indices in self.Schedule(feature_lengths):
+            encodings = torch.nn.utils.rnn.pad_sequence(
+                [encodings_list[index].T for index in batch_indices],
+                batch_first= True
+                ).permute(0, 2, 1)  # [Batch, Enc_d, Token_t]
+            durations = torch.nn.utils.rnn.pad_sequence(
+                [durations_list[index] for index in batch_indices],
+                batch_first= True
+                )   # [Batch, Token_t]
+
+            batch_features, batch_audios = self.Decode(encodings, durations, timing_dict)
+            for index, feature, audio in zip(batch_indices, batch_features, batch_audios):
+                features_list[valid_indices[index]] = feature
+                audios[valid_indices[index]] = audio
+
+        timing_dict = {stage: timing_dict[stage] for stage in self.stages}
+
+        return features_list, audios, timing_dict
+
+if __name__ == '__main__':
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument('-hp', '--hyper_parameters', required= True, type= str)
+    argParser.add_argument('-c', '--checkpoint', required= True, type= str)
+    argParser.add_argument('-v', '--vocoder', default= 'hifigan_ptransdifftts_exp12_500k.pts', type= str)
+    argParser.add_argument('-t', '--text', nargs= '+', required= True, type= str)
+    argParser.add_argument('-o', '--output_path', default= './results/Inference', type= str)
+    argParser.add_argument('-b', '--batch_size', default= None, type= int)
+    argParser.add_argument('-f', '--frame_budget', default= None, type= int)
+    argParser.add_argument('-sampler', '--sampler', default= None, type= str)
+    argParser.add_argument('-steps', '--sampling_steps', default= None, type= int)
+    argParser.add_argument('-eta', '--eta', default= None, type= float)
+    argParser.add_argument('-temp', '--temperature', default= None, type= float)
+    argParser.add_argument('-stream', '--stream', action= 'store_true')
+    args = argParser.parse_args()
+
+    inferencer = Inferencer(
+        hp_path= args.hyper_parameters,
+        checkpoint_path= args.checkpoint,
+        vocoder_path= args.vocoder,
+        batch_size= args.batch_size,
+        frame_budget= args.frame_budget,
+        sampler= args.sampler,
+        sampling_steps= args.sampling_steps,
+        eta= args.eta,
+        temperature= args.temperature
+        )
+    if args.stream:
+        audios, timing_dict = [], defaultdict(float)
+        for text in args.text:
+            audio_chunks = list(inferencer.Stream(text, timing_dict= timing_dict))
+            audios.append(np.concatenate(audio_chunks) if len(audio_chunks) > 0 else None)
+        timing_dict = {stage: timing_dict[stage] for stage in inferencer.stages}
+    else:
+        features_list, audios, timing_dict = inferencer.Inference(args.text)
+
+    os.makedirs(args.output_path, exist_ok= True)
+    for index, audio in enumerate(audios):
+        if audio is None:
+            continue
+        wavfile.write(
+            os.path.join(args.output_path, 'IDX_{}.wav'.format(index)).replace('\\', '/'),
+            inferencer.hp.Sound.Sample_Rate,
+            (np.clip(audio, -1.0, 1.0) * 32767.5).astype(np.int16)
+            )
+
+    total_time = sum(timing_dict.values())
+    total_audio_time = sum([audio.shape[0] for audio in audios if not audio is None]) / inferencer.hp.Sound.Sample_Rate
+    for stage, stage_time in timing_dict.items():
+        logging.info('{}: {:.3f} sec ({:.1f}%)'.format(stage, stage_time, stage_time / max(total_time, 1e-9) * 100.0))
+    logging.info('Total: {:.3f} sec, RTF: {:.4f}'.format(total_time, total_time / max(total_audio_time, 1e-9)))
@@ -1,9 +1,20 @@
 import torch
 import math
 from argparse import Namespace
-from typing import Optional, List, Dict, Union
+from typing import Optional, List, Dict, Union, Callable
 from .Layer import Conv1d, Lambda
-from tqdm import tqdm
+
+sampler_dict = {}   # name: (method, fixed keyword arguments)
+
+def Register_Sampler(name: str, **kwargs):
+    '''
+    A registered sampler is called by Diffusion.Inference with
+    conditions, num_steps, eta, temperature and spacing keyword arguments.
+    '''
+    def register(method):
+        sampler_dict[name] = (method, kwargs)
+        return method
+    return register
 
 class Diffusion(torch.nn.Module):
     def __init__(
@@ -44,14 +55,21 @@ class Diffusion(torch.nn.Module):
         self.register_buffer('posterior_mean_coef1', betas * alphas_cumprod_prev.sqrt() / (1.0 - alphas_cumprod))
         self.register_buffer('posterior_mean_coef2', (1.0 - alphas_cumprod_prev) * alphas.sqrt() / (1.0 - alphas_cumprod))
 
+        self.schedule_dict = {}  # (num_steps, method, eta, device): Sampling_Schedule
+
     def forward(
         self,
         conditions: torch.Tensor,
-        features: torch.Tensor= None
+        features: torch.Tensor= None,
+        sampler: Optional[str]= None,
+        sampling_steps: Optional[int]= None,
+        eta: Optional[float]= None,
+        temperature: Optional[float]= None
         ):
         '''
         conditions: [Batch, Enc_d, Feature_t]
         features: [Batch, Feature_d, Feature_t]
+        sampler, sampling_steps, eta, temperature: inference only. When None, the values of 'Diffusion.Sampling' are used.
         '''
         if not features is None:    # train
             diffusion_steps = torch.randint(
@@ -69,19 +87,57 @@ class Diffusion(torch.nn.Module):
                 )
             return None, noises, epsilons
         else:   # inference
-            features = self.Sampling(
+            features = self.Inference(
                 conditions= conditions,
+                sampler= sampler,
+                sampling_steps= sampling_steps,
+                eta= eta,
+                temperature= temperature
                 )
             return features, None, None
 
+    def Inference(
+        self,
+        conditions: torch.Tensor,
+        sampler: Optional[str]= None,
+        sampling_steps: Optional[int]= None,
+        eta: Optional[float]= None,
+        temperature: Optional[float]= None
+        ):
+        sampler = sampler or self.hp.Diffusion.Sampling.Sampler
+        sampling_steps = sampling_steps or self.hp.Diffusion.Sampling.Step
+        eta = eta if not eta is None else self.hp.Diffusion.Sampling.Eta
+        temperature = temperature if not temperature is None else self.hp.Diffusion.Sampling.Temperature
+
+        if not sampler in sampler_dict.keys():
+            raise NotImplementedError(f'There is no sampler called "{sampler}"')
+        method, sampler_kwargs = sampler_dict[sampler]
+
+        return method(
+            self,
+            conditions= conditions,
+            num_steps= sampling_steps,
+            eta= eta,
+            temperature= temperature,
+            spacing= self.hp.Diffusion.Sampling.Spacing,
+            **sampler_kwargs
+            )
+
+    @Register_Sampler('Ancestral')
     def Sampling(
         self,
         conditions: torch.Tensor,
+        temperature: float= 1.0,
+        **kwargs
         ):
+        '''
+        Always uses all steps. num_steps, eta and spacing are ignored.
+        '''
+        denoiser = self.Prepare_Denoiser(conditions)
         features = torch.randn(
             size= (conditions.size(0), self.feature_size, conditions.size(2)),
             device= conditions.device
-            )
+            ) * temperature
         for diffusion_step in reversed(range(self.timesteps)):
             features = self.P_Sampling(
                 features= features,
@@ -92,6 +148,8 @@ class Diffusion(torch.nn.Module):
                     dtype= torch.long,
                     device= conditions.device
                     ),
+                temperature= temperature,
+                denoiser= denoiser
                 )
         
         return features
@@ -100,15 +158,18 @@ class Diffusion(torch.nn.Module):
         self,
         conditions: torch.Tensor,
         diffusion_steps: torch.Tensor,
-        features: torch.Tensor,        
+        features: torch.Tensor,
+        temperature: float= 1.0,
+        denoiser: Optional[Callable]= None
         ):
         posterior_means, posterior_log_variances = self.Get_Posterior(
             features= features,
             diffusion_steps= diffusion_steps,
-            conditions= conditions
+            conditions= conditions,
+            denoiser= denoiser
             )
 
-        noises = torch.randn_like(features) # [Batch, Feature_d, Feature_d]
+        noises = torch.randn_like(features) * temperature # [Batch, Feature_d, Feature_d]
         masks = (diffusion_steps > 0).float().unsqueeze(1).unsqueeze(1) #[Batch, 1, 1]
         
         return posterior_means + masks * (0.5 * posterior_log_variances).exp() * noises
@@ -117,11 +178,15 @@ class Diffusion(torch.nn.Module):
         self,
         features: torch.Tensor,
         conditions: torch.Tensor,
-        diffusion_steps: torch.Tensor
+        diffusion_steps: torch.Tensor,
+        denoiser: Optional[Callable]= None
         ):
-        noised_predictions = self.denoiser(
+        '''
+        denoiser: the function from Prepare_Denoiser. When None, the conditions are projected in this call.
+        '''
+        denoiser = denoiser or self.Prepare_Denoiser(conditions)
+        noised_predictions = denoiser(
             features= features,
-            conditions= conditions,
             diffusion_steps= diffusion_steps
             )
 
@@ -158,48 +223,254 @@ class Diffusion(torch.nn.Module):
         
         return noises, epsilons
 
+    def Prepare_Denoiser(self, conditions: torch.Tensor):
+        '''
+        conditions: [Batch, Enc_d, Feature_t]
+        Returns a function of (features, diffusion_steps).
+        The conditions are same at every sampling step, so their projections are calculated once here and reused by every call.
+        The skip work buffer is also allocated once when gradient is disabled.
+        '''
+        if not torch.is_grad_enabled() and self.hp.Diffusion.Sampling.Window.Use:
+            margin = self.hp.Diffusion.Stack * (self.hp.Diffusion.Kernel_Size // 2)    # receptive field of one side
+            if conditions.size(2) > self.hp.Diffusion.Sampling.Window.Size + 2 * margin:
+                return self.Prepare_Windowed_Denoiser(
+                    conditions= conditions,
+                    core_size= self.hp.Diffusion.Sampling.Window.Size,
+                    margin= margin,
+                    max_windows= self.hp.Diffusion.Sampling.Window.Batch
+                    )
+
+        projected_conditions = self.denoiser.Project_Conditions(conditions)
+        skip_buffer = None if torch.is_grad_enabled() else conditions.new_empty(
+            conditions.size(0), self.hp.Diffusion.Size, conditions.size(2)
+            )
+
+        def denoiser(features: torch.Tensor, diffusion_steps: torch.Tensor):
+            return self.denoiser(
+                features= features,
+                conditions= conditions,
+                diffusion_steps= diffusion_steps,
+                projected_conditions= projected_conditions,
+                skip_buffer= skip_buffer
+                )
+
+        return denoiser
+
+    def Prepare_Windowed_Denoiser(
+        self,
+        conditions: torch.Tensor,
+        core_size: int,
+        margin: int,
+        max_windows: int
+        ):
+        '''
+        conditions: [Batch, Enc_d, Feature_t]
+        Returns a function of (features, diffusion_steps) like Prepare_Denoiser, but the denoiser runs on overlapped time windows.
+        Each window has core_size frames and margin context frames at both sides (clipped inside the sequence).
+        margin covers the receptive field of the denoiser, so the core of a window is same to the result on the whole sequence
+        and the cores are concatenated without cross-fade.
+        Windows are stacked in the batch dimension and at most max_windows windows are denoised at once,
+        so the memory of a step does not grow with Feature_t. Condition projections are not cached in this mode to keep the memory bounded.
+        '''
+        batch_size, _, length = conditions.size()
+        window_size = core_size + 2 * margin
+
+        core_starts = torch.arange(0, length, core_size)    # [Window]
+        window_starts = (core_starts - margin).clamp(0, length - window_size)   # [Window]
+        num_windows = core_starts.size(0)
+        window_indices = (window_starts[:, None] + torch.arange(window_size)[None, :]).to(conditions.device)  # [Window, Window_t]
+
+        frames = torch.arange(length)
+        core_windows = frames // core_size
+        core_indices = (core_windows * window_size + frames - window_starts[core_windows]).to(conditions.device)   # [Feature_t], index of flatten [Window * Window_t]
+
+        def Windowing(x: torch.Tensor):
+            '''
+            x: [Batch, Dim, Feature_t] -> [Batch * Window, Dim, Window_t]
+            '''
+            x = x[:, :, window_indices] # [Batch, Dim, Window, Window_t]
+            return x.permute(0, 2, 1, 3).reshape(batch_size * num_windows, x.size(1), window_size)
+
+        window_conditions = Windowing(conditions)
+        skip_buffer = conditions.new_empty(
+            min(max_windows, batch_size * num_windows), self.hp.Diffusion.Size, window_size
+            )
+
+        def denoiser(features: torch.Tensor, diffusion_steps: torch.Tensor):
+            window_features = Windowing(features)
+            window_diffusion_steps = diffusion_steps.repeat_interleave(num_windows)
+            predictions = torch.cat([
+                self.denoiser(
+                    features= window_features[start_index:start_index + max_windows],
+                    conditions= window_conditions[start_index:start_index + max_windows],
+                    diffusion_steps= window_diffusion_steps[start_index:start_index + max_windows],
+                    skip_buffer= skip_buffer[:min(max_windows, window_features.size(0) - start_index)]
+                    )
+                for start_index in range(0, window_features.size(0), max_windows)
+                ], dim= 0)  # [Batch * Window, Feature_d, Window_t]
+            predictions = predictions.view(batch_size, num_windows, -1, window_size).permute(0, 2, 1, 3)
+            predictions = predictions.reshape(batch_size, -1, num_windows * window_size)
+
+            return predictions[:, :, core_indices]
+
+        return denoiser
+
+    @Register_Sampler('DDIM')
     def DDIM(
         self,
         conditions: torch.Tensor,
-        num_ddim_timesteps: int,
+        num_steps: int,
         eta: float= 0.0,
-        temperature: float= 1.0
+        temperature: float= 1.0,
+        spacing: str= 'uniform',
+        **kwargs
         ):
-        ddim_timesteps = self.Get_DDIM_Steps(
-            num_ddim_timesteps= num_ddim_timesteps
-            )
-        sigmas, alphas, alphas_prev = self.Get_DDIM_Sampling_Parameters(
-            ddim_timesteps= ddim_timesteps,
-            eta= eta
+        schedule = self.Get_Sampling_Schedule(
+            num_steps= num_steps,
+            method= spacing,
+            eta= eta,
+            device= conditions.device
             )
-        sqrt_one_minus_alphas = (1. - alphas).sqrt()
 
         features = torch.randn(
             size= (conditions.size(0), self.feature_size, conditions.size(2)),
             device= conditions.device
+            ) * temperature
+        denoiser = self.Prepare_Denoiser(conditions)
+
+        for index, diffusion_steps in enumerate(schedule.timesteps):
+            noised_predictions = denoiser(
+                features= features,
+                diffusion_steps= diffusion_steps.expand(conditions.size(0))
+                )
+
+            feature_starts = \
+                features * schedule.sqrt_recip_alphas[index] - \
+                noised_predictions * schedule.sqrt_recipm1_alphas[index]
+            feature_starts.clamp_(-1.0, 1.0)  # clipped
+            noised_predictions = (features - schedule.sqrt_alphas[index] * feature_starts) * schedule.recip_sqrt_one_minus_alphas[index]
+
+            features = \
+                schedule.sqrt_alphas_prev[index] * feature_starts + \
+                schedule.direction_coefs[index] * noised_predictions
+            if schedule.sigmas[index] > 0.0:
+                features = features + schedule.sigmas[index] * temperature * torch.randn_like(features)
+
+        return features
+
+    # https://arxiv.org/abs/2211.01095
+    @Register_Sampler('DPM_Solver++_3M', order= 3)
+    @Register_Sampler('DPM_Solver++_2M', order= 2)
+    def DPM_Solver(
+        self,
+        conditions: torch.Tensor,
+        num_steps: int,
+        temperature: float= 1.0,
+        spacing: str= 'uniform',
+        order: int= 2,
+        **kwargs
+        ):
+        '''
+        Multistep DPM-Solver++ with data prediction. The denoiser is called once per step.
+        The order is lowered at the first and the last steps. eta is ignored.
+        '''
+        schedule = self.Get_Sampling_Schedule(
+            num_steps= num_steps,
+            method= spacing,
+            device= conditions.device
             )
 
-        for diffusion_steps in tqdm(
-            reversed(range(num_ddim_timesteps)),
-            desc= '[Diffusion]',
-            total= num_ddim_timesteps
-            ):
-            noised_predictions = self.denoiser(
+        features = torch.randn(
+            size= (conditions.size(0), self.feature_size, conditions.size(2)),
+            device= conditions.device
+            ) * temperature
+        denoiser = self.Prepare_Denoiser(conditions)
+
+        feature_starts_list = []    # The latest is the first.
+        for index, diffusion_steps in enumerate(schedule.timesteps):
+            noised_predictions = denoiser(
                 features= features,
-                conditions= conditions,
-                diffusion_steps= torch.full(
-                    size= (conditions.size(0), ),
-                    fill_value= diffusion_steps,
-                    dtype= torch.long,
-                    device= conditions.device
-                    )
+                diffusion_steps= diffusion_steps.expand(conditions.size(0))
                 )
 
-            feature_starts = (features - sqrt_one_minus_alphas[diffusion_steps] * noised_predictions) / alphas[diffusion_steps].sqrt()
-            direction_pointings = (1.0 - alphas_prev[diffusion_steps] - sigmas[diffusion_steps].pow(2.0)) * noised_predictions
-            noises = sigmas[diffusion_steps] * torch.randn_like(features) * temperature
+            feature_starts = \
+                features * schedule.sqrt_recip_alphas[index] - \
+                noised_predictions * schedule.sqrt_recipm1_alphas[index]
+            feature_starts.clamp_(-1.0, 1.0)  # clipped
+            feature_starts_list = [feature_starts] + feature_starts_list[:order - 1]
+
+            current_order = min(order, index + 1, len(schedule) - index)
+            features = schedule.dpm_ratios[index] * features + schedule.dpm_coefs_0[index] * feature_starts
+            if current_order == 2:
+                r0 = schedule.dpm_hs[index - 1] / schedule.dpm_hs[index]
+                features = features + schedule.dpm_coefs_0[index] * 0.5 / r0 * (feature_starts - feature_starts_list[1])
+            elif current_order == 3:
+                r0 = schedule.dpm_hs[index - 1] / schedule.dpm_hs[index]
+                r1 = schedule.dpm_hs[index - 2] / schedule.dpm_hs[index]
+                derivatives_0 = (feature_starts - feature_starts_list[1]) / r0
+                derivatives_1 = (feature_starts_list[1] - feature_starts_list[2]) / r1
+                derivatives_2 = (derivatives_0 - derivatives_1) / (r0 + r1)
+                derivatives_1 = derivatives_0 + r0 * derivatives_2
+                features = \
+                    features + \
+                    schedule.dpm_coefs_1[index] * derivatives_1 - \
+                    schedule.dpm_coefs_2[index] * derivatives_2
 
-            features = alphas_prev[diffusion_steps].sqrt() * feature_starts + direction_pointings + noises
+        return features
+
+    # https://arxiv.org/abs/2206.00364
+    @Register_Sampler('Heun')
+    def Heun(
+        self,
+        conditions: torch.Tensor,
+        num_steps: int,
+        temperature: float= 1.0,
+        spacing: str= 'uniform',
+        **kwargs
+        ):
+        '''
+        Heun's 2nd order method on the probability flow ODE in the variance exploding form (x / sqrt(alpha)).
+        The denoiser is called 2 * num_steps - 1 times. eta is ignored.
+        '''
+        schedule = self.Get_Sampling_Schedule(
+            num_steps= num_steps,
+            method= spacing,
+            device= conditions.device
+            )
+
+        features = torch.randn(
+            size= (conditions.size(0), self.feature_size, conditions.size(2)),
+            device= conditions.device
+            ) * temperature
+        features = features * schedule.sqrt_recip_alphas[0]   # variance exploding form
+        denoiser = self.Prepare_Denoiser(conditions)
+
+        def Get_Derivatives(features, diffusion_steps, sqrt_alphas, sigmas):
+            noised_predictions = denoiser(
+                features= features * sqrt_alphas,
+                diffusion_steps= diffusion_steps.expand(conditions.size(0))
+                )
+            feature_starts = (features - noised_predictions * sigmas).clamp(-1.0, 1.0)  # clipped
+            return (features - feature_starts) / sigmas
+
+        for index, diffusion_steps in enumerate(schedule.timesteps):
+            sigmas, sigmas_prev = schedule.sqrt_recipm1_alphas[index], schedule.sqrt_recipm1_alphas_prev[index]
+            derivatives = Get_Derivatives(
+                features= features,
+                diffusion_steps= diffusion_steps,
+                sqrt_alphas= schedule.sqrt_alphas[index],
+                sigmas= sigmas
+                )
+            features_prev = features + (sigmas_prev - sigmas) * derivatives
+            if index < len(schedule) - 1:   # The last step goes to the clean feature by Euler.
+                derivatives_prev = Get_Derivatives(
+                    features= features_prev,
+                    diffusion_steps= schedule.timesteps[index + 1],
+                    sqrt_alphas= schedule.sqrt_alphas_prev[index],
+                    sigmas= sigmas_prev
+                    )
+                features_prev = features + (sigmas_prev - sigmas) * 0.5 * (derivatives + derivatives_prev)
+            features = features_prev
 
         return features
 
@@ -209,23 +480,97 @@ class Diffusion(torch.nn.Module):
         num_ddim_timesteps: int,
         ddim_discr_method: str= 'uniform'
         ):
-        if ddim_discr_method == 'uniform':            
-            ddim_timesteps = torch.range(0, self.timesteps, self.timesteps // num_ddim_timesteps).long()
+        '''
+        Returns the ascending diffusion steps of the sub-sequence without duplication.
+        '''
+        num_ddim_timesteps = min(max(num_ddim_timesteps, 1), self.timesteps)
+        if ddim_discr_method == 'uniform':
+            ddim_timesteps = torch.arange(num_ddim_timesteps) * (self.timesteps // num_ddim_timesteps)
+            ddim_timesteps[-1] = self.timesteps - 1
         elif ddim_discr_method == 'quad':
-            ddim_timesteps = torch.linspace(0, (torch.tensor(self.timesteps) * 0.8).sqrt(), num_ddim_timesteps).pow(2.0).long()
+            ddim_timesteps = torch.linspace(0, math.sqrt(self.timesteps * 0.8), num_ddim_timesteps).pow(2.0).long()
+            ddim_timesteps[-1] = self.timesteps - 1
+        elif ddim_discr_method == 'trailing':
+            ddim_timesteps = (torch.arange(1, num_ddim_timesteps + 1) * (self.timesteps / num_ddim_timesteps)).round().long() - 1
         else:
             raise NotImplementedError(f'There is no ddim discretization method called "{ddim_discr_method}"')
-        
-        ddim_timesteps[-1] = self.timesteps - 1
 
-        return ddim_timesteps
+        return torch.unique(ddim_timesteps)   # sorted
 
-    def Get_DDIM_Sampling_Parameters(self, ddim_timesteps, eta):
-        alphas = self.alphas_cumprod[ddim_timesteps]
-        alphas_prev = self.alphas_cumprod_prev[ddim_timesteps]
-        sigmas = eta * ((1 - alphas_prev) / (1 - alphas) * (1 - alphas / alphas_prev)).sqrt()
+    def Get_Sampling_Schedule(
+        self,
+        num_steps: int,
+        method: str= 'uniform',
+        eta: float= 0.0,
+        device: torch.device= None
+        ):
+        key = (num_steps, method, eta, str(device or self.alphas_cumprod.device))
+        if not key in self.schedule_dict.keys():
+            self.schedule_dict[key] = Sampling_Schedule(
+                timesteps= self.Get_DDIM_Steps(
+                    num_ddim_timesteps= num_steps,
+                    ddim_discr_method= method
+                    ),
+                alphas_cumprod= self.alphas_cumprod,
+                eta= eta,
+                device= device or self.alphas_cumprod.device
+                )
 
-        return sigmas, alphas, alphas_prev
+        return self.schedule_dict[key]
+
+class Sampling_Schedule:
+    '''
+    The timesteps and per-step coefficients of a diffusion sub-sequence.
+    Coefficients are calculated once in float64 and kept as python floats, so a sampling step does not need any setup.
+    All values are in sampling order (the largest step first).
+    '''
+    def __init__(
+        self,
+        timesteps: torch.Tensor,
+        alphas_cumprod: torch.Tensor,
+        eta: float,
+        device: torch.device
+        ):
+        '''
+        timesteps: [Step], ascending
+        alphas_cumprod: [Diffusion_t]
+        '''
+        alphas = alphas_cumprod.detach().cpu().double()[timesteps]
+        alphas_prev = torch.cat([torch.ones(1, dtype= torch.float64), alphas[:-1]])   # The previous of the smallest step is the clean feature.
+        sigmas = eta * ((1.0 - alphas_prev) / (1.0 - alphas) * (1.0 - alphas / alphas_prev)).sqrt()
+
+        self.timesteps = timesteps.flip(0).to(device)   # [Step]
+        self.alphas = alphas.flip(0).tolist()
+        self.alphas_prev = alphas_prev.flip(0).tolist()
+        self.sqrt_alphas = alphas.sqrt().flip(0).tolist()
+        self.sqrt_alphas_prev = alphas_prev.sqrt().flip(0).tolist()
+        self.sqrt_recip_alphas = (1.0 / alphas).sqrt().flip(0).tolist()
+        self.sqrt_recipm1_alphas = (1.0 / alphas - 1.0).sqrt().flip(0).tolist()
+        self.recip_sqrt_one_minus_alphas = (1.0 / (1.0 - alphas).sqrt()).flip(0).tolist()
+        self.direction_coefs = (1.0 - alphas_prev - sigmas.pow(2.0)).clamp(min= 0.0).sqrt().flip(0).tolist()
+        self.sigmas = sigmas.flip(0).tolist()
+        self.sqrt_recipm1_alphas_prev = (1.0 / alphas_prev - 1.0).sqrt().flip(0).tolist()
+
+        # DPM-Solver++ coefficients from each step to the next step.
+        self.dpm_hs, self.dpm_ratios, self.dpm_coefs_0, self.dpm_coefs_1, self.dpm_coefs_2 = [], [], [], [], []
+        for alpha, alpha_prev in zip(self.alphas, self.alphas_prev):
+            if alpha_prev >= 1.0:   # to the clean feature, lambda_prev is infinity.
+                self.dpm_hs.append(math.inf)
+                self.dpm_ratios.append(0.0)
+                self.dpm_coefs_0.append(1.0)
+                self.dpm_coefs_1.append(0.0)
+                self.dpm_coefs_2.append(0.0)
+                continue
+            h = 0.5 * (math.log(alpha_prev / (1.0 - alpha_prev)) - math.log(alpha / (1.0 - alpha)))
+            phi = math.expm1(-h)
+            self.dpm_hs.append(h)
+            self.dpm_ratios.append(math.sqrt((1.0 - alpha_prev) / (1.0 - alpha)))
+            self.dpm_coefs_0.append(-math.sqrt(alpha_prev) * phi)
+            self.dpm_coefs_1.append(math.sqrt(alpha_prev) * (phi / h + 1.0))
+            self.dpm_coefs_2.append(math.sqrt(alpha_prev) * ((phi + h) / h ** 2 - 0.5))
+
+    def __len__(self):
+        return len(self.alphas)
 
 
 class Denoiser(torch.nn.Module):
@@ -298,37 +643,97 @@ class Denoiser(torch.nn.Module):
             )
         torch.nn.init.zeros_(self.projection[-1].weight)    # This is key factor....
         torch.nn.init.zeros_(self.projection[-1].bias)    # This is key factor....
+
+        self.diffusion_table = None # [Stack, Max_Step, Res_d], inference only. This is not a part of state dict.
             
     def forward(
         self,
         features: torch.Tensor,
         conditions: torch.Tensor,
-        diffusion_steps: torch.Tensor
+        diffusion_steps: torch.Tensor,
+        projected_conditions: Optional[List[torch.Tensor]]= None,
+        skip_buffer: Optional[torch.Tensor]= None
         ):
         '''
         features: [Batch, Feature_d, Feature_t]
         encodings: [Batch, Feature_d, Feature_t]
         diffusion_steps: [Batch]
+        projected_conditions: the result of Project_Conditions. If None, the conditions are projected in each block.
+        skip_buffer: [Batch, Res_d, Feature_t], a work buffer reused by every sampling step. This is used only when gradient is disabled.
         '''
         x = self.prenet(features)
         
-        diffusion_steps = self.diffusion_embedding(diffusion_steps) # [Batch, Res_d, 1]
-        diffusion_steps = self.embedding_ffn(diffusion_steps) # [Batch, Res_d, 1]
+        if not self.training and not torch.is_grad_enabled():
+            projected_diffusions = self.Get_Diffusion_Table(x)[:, diffusion_steps].unsqueeze(3)  # [Stack, Batch, Res_d, 1]
+        else:
+            diffusion_steps = self.diffusion_embedding(diffusion_steps) # [Batch, Res_d, 1]
+            diffusion_steps = self.embedding_ffn(diffusion_steps) # [Batch, Res_d, 1]
+            projected_diffusions = [None] * len(self.blocks)
         
-        skips_list = []
-        for residual_block in self.blocks:
+        projected_conditions = projected_conditions or [None] * len(self.blocks)
+        skips_sum = None    # Running sum, so only one skip tensor is alive instead of Stack of them.
+        for residual_block, block_conditions, block_diffusions in zip(self.blocks, projected_conditions, projected_diffusions):
             x, skips = residual_block(
                 x= x,
                 conditions= conditions,
-                diffusions= diffusion_steps
+                diffusions= diffusion_steps,
+                projected_conditions= block_conditions,
+                projected_diffusions= block_diffusions
                 )
-            skips_list.append(skips)
-
-        x = torch.stack(skips_list, dim= 0).sum(dim= 0) / math.sqrt(self.hp.Diffusion.Stack)
+            if torch.is_grad_enabled():
+                skips_sum = skips if skips_sum is None else skips_sum + skips
+            elif skips_sum is None:
+                skips_sum = skips if skip_buffer is None else skip_buffer.copy_(skips)
+            else:
+                skips_sum.add_(skips)
+
+        if torch.is_grad_enabled():
+            x = skips_sum / math.sqrt(self.hp.Diffusion.Stack)
+        else:
+            x = skips_sum.mul_(1.0 / math.sqrt(self.hp.Diffusion.Stack))
         x = self.projection(x)
 
         return x
 
+    def Project_Conditions(self, conditions: torch.Tensor):
+        '''
+        conditions: [Batch, Enc_d, Feature_t]
+        The condition convolutions of all blocks are calculated by one convolution.
+        Returns a list of [Batch, Res_d * 2, Feature_t] tensors, one for each block.
+        '''
+        weights = torch.cat([block.condition.weight for block in self.blocks], dim= 0)
+        biases = torch.cat([block.condition.bias for block in self.blocks], dim= 0)
+
+        return list(torch.nn.functional.conv1d(conditions, weights, biases).chunk(chunks= len(self.blocks), dim= 1))
+
+    @torch.no_grad()
+    def Get_Diffusion_Table(self, x: torch.Tensor):
+        '''
+        Diffusion steps are integers in [0, Max_Step), so the embedding, embedding_ffn and the diffusion projection of every block are tabulated once.
+        The table is built lazily and removed when the mode is changed or the weights are loaded.
+        Returns [Stack, Max_Step, Res_d]
+        '''
+        if self.diffusion_table is None or self.diffusion_table.device != x.device or self.diffusion_table.dtype != x.dtype:
+            diffusion_steps = torch.arange(self.hp.Diffusion.Max_Step, device= x.device)
+            diffusion_steps = self.diffusion_embedding(diffusion_steps) # [Max_Step, Res_d, 1]
+            diffusion_steps = self.embedding_ffn(diffusion_steps) # [Max_Step, Res_d, 1]
+
+            weights = torch.cat([block.diffusion.weight for block in self.blocks], dim= 0)
+            biases = torch.cat([block.diffusion.bias for block in self.blocks], dim= 0)
+            diffusion_table = torch.nn.functional.conv1d(diffusion_steps, weights, biases)   # [Max_Step, Stack * Res_d, 1]
+            diffusion_table = diffusion_table.view(diffusion_table.size(0), len(self.blocks), -1).permute(1, 0, 2)  # [Stack, Max_Step, Res_d]
+            self.diffusion_table = diffusion_table.to(dtype= x.dtype).contiguous()
+
+        return self.diffusion_table
+
+    def train(self, mode: bool= True):
+        self.diffusion_table = None
+        return super().train(mode)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self.diffusion_table = None
+        return super()._load_from_state_dict(*args, **kwargs)
+
 class Diffusion_Embedding(torch.nn.Module):
     def __init__(
         self,
@@ -386,12 +791,14 @@ class Residual_Block(torch.nn.Module):
         self,
         x: torch.Tensor,
         conditions: torch.Tensor,
-        diffusions: torch.Tensor
+        diffusions: torch.Tensor,
+        projected_conditions: Optional[torch.Tensor]= None,
+        projected_diffusions: Optional[torch.Tensor]= None
         ):
         residuals = x
 
-        conditions = self.condition(conditions)
-        diffusions = self.diffusion(diffusions)
+        conditions = projected_conditions if not projected_conditions is None else self.condition(conditions)
+        diffusions = projected_diffusions if not projected_diffusions is None else self.diffusion(diffusions)
 
         x = self.conv(x + diffusions) + conditions
         x_a, x_b = x.chunk(chunks= 2, dim= 1)
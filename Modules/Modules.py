@@ -2,7 +2,7 @@ from argparse import Namespace
 import torch
 import numpy as np
 import math
-from numba import jit
+from numba import jit, prange
 from typing import Optional, List, Dict, Tuple, Union
 
 from .Diffusion import Diffusion
@@ -17,7 +17,12 @@ class GradTTS(torch.nn.Module):
         self.variance_predictor_block = Variance_Predictor_Block(self.hp)
         self.diffusion = Diffusion(self.hp)
         
-        self.maximum_path_generator = Maximum_Path_Generator()
+        self.maximum_path_generator = Maximum_Path_Generator(
+            use_device= self.hp.Train.Alignment_on_Device
+            )
+        self.banded_duration_generator = Banded_Duration_Generator(
+            band_width= self.hp.Train.Alignment_Band_Width
+            )
         self.segment = Segment()
 
     def forward(
@@ -25,19 +30,29 @@ class GradTTS(torch.nn.Module):
         tokens: torch.Tensor,
         token_lengths: torch.Tensor,
         features: torch.FloatTensor= None,
-        feature_lengths: torch.Tensor= None
+        feature_lengths: torch.Tensor= None,
+        sampler: Optional[str]= None,
+        sampling_steps: Optional[int]= None,
+        eta: Optional[float]= None,
+        temperature: Optional[float]= None,
+        durations: Optional[torch.Tensor]= None
         ):
         if not features is None and not feature_lengths is None:    # train
             return self.Train(
                 tokens= tokens,
                 token_lengths= token_lengths,
                 features= features,
-                feature_lengths= feature_lengths
+                feature_lengths= feature_lengths,
+                durations= durations
                 )
         else:   #  inference
             return self.Inference(
                 tokens= tokens,
-                token_lengths= token_lengths
+                token_lengths= token_lengths,
+                sampler= sampler,
+                sampling_steps= sampling_steps,
+                eta= eta,
+                temperature= temperature
                 )
 
     def Train(
@@ -45,26 +60,40 @@ class GradTTS(torch.nn.Module):
         tokens: torch.Tensor,
         token_lengths: torch.Tensor,
         features: torch.FloatTensor,
-        feature_lengths: torch.Tensor
+        feature_lengths: torch.Tensor,
+        durations: Optional[torch.Tensor]= None
         ):
+        '''
+        durations: [Batch, Token_t]. When given, e.g. from the duration cache, the monotonic alignment search is skipped.
+        '''
         encodings, means_p, log_stds_p, token_masks = self.encoder(tokens, token_lengths)   # [Batch, Enc_d, Token_t], [Batch, Enc_d, Token_t]
         feature_masks = (~Mask_Generate(
             lengths= feature_lengths,
             max_length= torch.ones_like(features[0, 0]).sum()
             )).unsqueeze(1).float()
 
-        with torch.no_grad():
-            # negative cross-entropy
-            stds_p_sq_r = torch.exp(-2 * log_stds_p) # [Batch, Enc_d, Token_t]
-            neg_cent1 = torch.sum(-0.5 * math.log(2 * math.pi) - log_stds_p, [1], keepdim=True) # [Batch, 1, Token_t]
-            neg_cent2 = torch.matmul(-0.5 * (features ** 2).permute(0, 2, 1), stds_p_sq_r) # [Batch, Feature_t, Enc_d] x [Batch, Enc_d, Token_t] -> [Batch, Feature_t, Token_t]
-            neg_cent3 = torch.matmul(features.permute(0, 2, 1), (means_p * stds_p_sq_r)) # [Batch, Feature_t, Enc_d] x [b, Enc_d, Token_t] -> [Batch, Feature_t, Token_t]
-            neg_cent4 = torch.sum(-0.5 * (means_p ** 2) * stds_p_sq_r, [1], keepdim=True) # [Batch, 1, Token_t]
-            neg_cent = neg_cent1 + neg_cent2 + neg_cent3 + neg_cent4    # [Batch, Feature_t, Token_t]
-
-            attention_masks = token_masks * feature_masks.permute(0, 2, 1)  # [Batch, 1, Token_t] x [Batch, Feature_t, 1] -> [Batch, Feature_t, Token_t]
-            attentions = self.maximum_path_generator(neg_cent, attention_masks).detach()
-            durations = attentions.sum(dim= 1).long()    # [Batch, Token_t]        
+        if durations is None:
+            with torch.no_grad():
+                if self.hp.Train.Alignment_Band_Width > 0:
+                    durations = self.banded_duration_generator(
+                        features= features,
+                        means_p= means_p,
+                        log_stds_p= log_stds_p,
+                        token_lengths= token_lengths,
+                        feature_lengths= feature_lengths
+                        )   # [Batch, Token_t]
+                else:
+                    # negative cross-entropy
+                    stds_p_sq_r = torch.exp(-2 * log_stds_p) # [Batch, Enc_d, Token_t]
+                    neg_cent1 = torch.sum(-0.5 * math.log(2 * math.pi) - log_stds_p, [1], keepdim=True) # [Batch, 1, Token_t]
+                    neg_cent2 = torch.matmul(-0.5 * (features ** 2).permute(0, 2, 1), stds_p_sq_r) # [Batch, Feature_t, Enc_d] x [Batch, Enc_d, Token_t] -> [Batch, Feature_t, Token_t]
+                    neg_cent3 = torch.matmul(features.permute(0, 2, 1), (means_p * stds_p_sq_r)) # [Batch, Feature_t, Enc_d] x [b, Enc_d, Token_t] -> [Batch, Feature_t, Token_t]
+                    neg_cent4 = torch.sum(-0.5 * (means_p ** 2) * stds_p_sq_r, [1], keepdim=True) # [Batch, 1, Token_t]
+                    neg_cent = neg_cent1 + neg_cent2 + neg_cent3 + neg_cent4    # [Batch, Feature_t, Token_t]
+
+                    attention_masks = token_masks * feature_masks.permute(0, 2, 1)  # [Batch, 1, Token_t] x [Batch, Feature_t, 1] -> [Batch, Feature_t, Token_t]
+                    attentions = self.maximum_path_generator(neg_cent, attention_masks).detach()
+                    durations = attentions.sum(dim= 1).long()    # [Batch, Token_t]        
 
         encodings, means_p, log_stds_p, log_duration_predictions = self.variance_predictor_block(
             encodings= encodings,
@@ -73,17 +102,12 @@ class GradTTS(torch.nn.Module):
             durations= durations
             )
 
-        encodings_slice, offsets = self.segment(
-            patterns= encodings.permute(0, 2, 1),
+        (encodings_slice, features_slice), offsets = self.segment(
+            patterns= [encodings.permute(0, 2, 1), features.permute(0, 2, 1)],
             segment_size= self.hp.Train.Segment_Size,
             lengths= feature_lengths
             )
         encodings_slice = encodings_slice.permute(0, 2, 1)
-        features_slice, _ = self.segment(
-            patterns= features.permute(0, 2, 1),
-            segment_size= self.hp.Train.Segment_Size,
-            offsets= offsets
-            )
         features_slice = features_slice.permute(0, 2, 1)
         predictions_slice, noises, epsilons = self.diffusion(
             conditions= encodings_slice,
@@ -96,6 +120,10 @@ class GradTTS(torch.nn.Module):
         self,
         tokens: torch.Tensor,
         token_lengths: torch.Tensor,
+        sampler: Optional[str]= None,
+        sampling_steps: Optional[int]= None,
+        eta: Optional[float]= None,
+        temperature: Optional[float]= None
         ):
         encodings, _, _, _ = self.encoder(tokens, token_lengths)   # [Batch, Enc_d, Token_t], [Batch, Enc_d, Token_t]
         encodings, _, _, log_duration_predictions = self.variance_predictor_block(
@@ -103,7 +131,11 @@ class GradTTS(torch.nn.Module):
             )
 
         predictions, _, _ = self.diffusion(
-            conditions= encodings
+            conditions= encodings,
+            sampler= sampler,
+            sampling_steps= sampling_steps,
+            eta= eta,
+            temperature= temperature
             )
 
         return predictions, None, None, log_duration_predictions, None, None, None
@@ -322,20 +354,13 @@ class Variance_Predictor_Block(torch.nn.Module):
             durations = (log_duration_predictions.exp() - 1).clip(0, 50).ceil().long()
             durations[:, -1] += durations.sum(dim= 1).max() - durations.sum(dim= 1) # Align the sum of lengths
 
-        encodings = self.length_regulator(
-            encodings= encodings,
+        expanded = iter(self.length_regulator(
+            encodings= [x for x in [encodings, means_p, log_stds_p] if not x is None],
             durations= durations
-            )
-        if not means_p is None:
-            means_p = self.length_regulator(
-                encodings= means_p,
-                durations= durations
-                )
-        if not log_stds_p is None:
-            log_stds_p = self.length_regulator(
-                encodings= log_stds_p,
-                durations= durations
-                )
+            ))
+        encodings = next(expanded)
+        means_p = next(expanded) if not means_p is None else None
+        log_stds_p = next(expanded) if not log_stds_p is None else None
         
         return encodings, means_p, log_stds_p, log_duration_predictions
 
@@ -399,41 +424,59 @@ class Variance_Predictor(torch.nn.Sequential):
 class Length_Regulator(torch.nn.Module):
     def forward(
         self,
-        encodings= torch.Tensor,
-        durations= torch.Tensor
+        encodings: Union[torch.Tensor, List[torch.Tensor]],
+        durations: torch.Tensor
         ):
+        '''
+        encodings: [Batch, Enc_d, Enc_t] or a list of them which share the durations.
+        durations: [Batch, Enc_t]
+        The frames after the sum of durations are zero.
+        '''
+        is_list = isinstance(encodings, (list, tuple))
+        encodings = encodings if is_list else [encodings]
+
         durations = torch.cat([
             durations,
             durations.sum(dim= 1).max() - durations.sum(dim= 1, keepdim= True)
             ], dim= 1)
-        encodings = torch.cat([encodings, torch.zeros_like(encodings[:, :, -1:])], dim= 2)
 
-        return torch.stack([
-            encoding.repeat_interleave(duration, dim= 1)
-            for encoding, duration in zip(encodings, durations)
-            ], dim= 0)
+        encodings = [
+            torch.stack([
+                encoding.repeat_interleave(duration, dim= 1)
+                for encoding, duration in zip(
+                    torch.cat([encoding_batch, torch.zeros_like(encoding_batch[:, :, -1:])], dim= 2),
+                    durations
+                    )
+                ], dim= 0)
+            for encoding_batch in encodings
+            ]   # [Batch, Enc_d, Feature_t]
+
+        return encodings if is_list else encodings[0]
 
 class Segment(torch.nn.Module):
     def forward(
         self,
-        patterns: torch.Tensor,
+        patterns: Union[torch.Tensor, List[torch.Tensor]],
         segment_size: int,
         lengths: torch.Tensor= None,
         offsets: torch.Tensor= None
         ):
         '''
-        patterns: [Batch, Time, ...]
+        patterns: [Batch, Time, ...] or a list of them which share the offsets.
         lengths: [Batch]
-        segment_size: an integer scalar    
+        segment_size: an integer scalar
+        The [Batch, Segment_t] index is built once and every pattern is sliced by one gather.
         '''
+        is_list = isinstance(patterns, (list, tuple))
+        patterns = patterns if is_list else [patterns]
+
         if offsets is None:
-            offsets = (torch.rand_like(patterns[:, 0, 0]) * (lengths - segment_size)).long()
-        segments = torch.stack([
-            pattern[offset:offset + segment_size]
-            for pattern, offset in zip(patterns, offsets)
-            ], dim= 0)
-        
-        return segments, offsets
+            offsets = (torch.rand_like(patterns[0][:, 0, 0]) * (lengths - segment_size)).long().clamp(min= 0)
+        batch_indices = torch.arange(offsets.size(0), device= offsets.device)[:, None]    # [Batch, 1]
+        time_indices = offsets[:, None] + torch.arange(segment_size, device= offsets.device)[None, :]  # [Batch, Segment_t]
+        segments = [pattern[batch_indices, time_indices] for pattern in patterns]  # [Batch, Segment_t, ...]
+
+        return (segments if is_list else segments[0]), offsets
 
 
 # https://pytorch.org/tutorials/beginner/transformer_tutorial.html
@@ -475,55 +518,209 @@ class Periodic_Positional_Encoding(torch.nn.Module):
         return pe[:, :, :x.size(2)]
 
 class Maximum_Path_Generator(torch.nn.Module):
+    def __init__(self, use_device: bool= False):
+        super().__init__()
+        self.use_device = use_device
+
     def forward(self, neg_cent, mask):
         '''
         x: [Batch, Feature_t, Token_t]
         mask: [Batch, Feature_t, Token_t]
+        When use_device is true and the tensors are on GPU, the search runs on the device by calc_paths_torch.
+        Otherwise, the numba kernel processes the batch in parallel on CPU.
         '''
         neg_cent *= mask
         device, dtype = neg_cent.device, neg_cent.dtype
-        neg_cent = neg_cent.data.cpu().numpy().astype(np.float32)
-        mask = mask.data.cpu().numpy()
 
-        token_lengths = mask.sum(axis= 2)[:, 0].astype('int32')   # [Batch]
-        feature_lengths = mask.sum(axis= 1)[:, 0].astype('int32')   # [Batch]
+        token_lengths = mask.sum(dim= 2)[:, 0].long()   # [Batch]
+        feature_lengths = mask.sum(dim= 1)[:, 0].long()   # [Batch]
 
-        paths = self.calc_paths(neg_cent, token_lengths, feature_lengths)
+        if self.use_device and neg_cent.is_cuda:
+            return self.calc_paths_torch(neg_cent, token_lengths, feature_lengths, dtype)
+
+        neg_cent = np.ascontiguousarray(neg_cent.data.cpu().numpy(), dtype= np.float32)    # No copy when neg_cent is already a float32 CPU tensor.
+        paths = np.zeros(neg_cent.shape, dtype= np.int32)
+        Calc_Paths(
+            paths,
+            neg_cent,
+            token_lengths.cpu().numpy().astype(np.int32),
+            feature_lengths.cpu().numpy().astype(np.int32)
+            )
 
         return torch.from_numpy(paths).to(device= device, dtype= dtype)
 
-    def calc_paths(self, neg_cent, token_lengths, feature_lengths):
-        return np.stack([
-            Maximum_Path_Generator.calc_path(x, token_length, feature_length)
-            for x, token_length, feature_length in zip(neg_cent, token_lengths, feature_lengths)
-            ], axis= 0)
-
-    @staticmethod
-    @jit(nopython=True)
-    def calc_path(x, token_length, feature_length):
-        path = np.zeros_like(x, dtype= np.int32)
-        for feature_index in range(feature_length):
-            for token_index in range(max(0, token_length + feature_index - feature_length), min(token_length, feature_index + 1)):
-                if feature_index == token_index:
-                    current_q = -1e+9
-                else:
-                    current_q = x[feature_index - 1, token_index]   # Stayed current token
-                if token_index == 0:
-                    if feature_index == 0:
-                        prev_q = 0.0
-                    else:
-                        prev_q = -1e+9
+    @torch.no_grad()
+    def calc_paths_torch(self, neg_cent, token_lengths, feature_lengths, dtype= torch.float32):
+        '''
+        neg_cent: [Batch, Feature_t, Token_t], masked
+        token_lengths: [Batch]
+        feature_lengths: [Batch]
+        Same search to Calc_Path. Each feature row depends only on the previous row,
+        so the forward pass is vectorized over the batch and the tokens and loops over Feature_t.
+        Both the forward pass and the backtrack launch small kernels Feature_t times sequentially.
+        '''
+        batch_size, feature_length, token_length = neg_cent.size()
+        values = neg_cent.float().clone()  # [Batch, Feature_t, Token_t]
+        values[:, 0, 1:] = -math.inf    # Only the first token is reachable at the first frame.
+        for feature_index in range(1, feature_length):
+            previous_values = values[:, feature_index - 1]  # [Batch, Token_t]
+            moved_values = torch.nn.functional.pad(previous_values[:, :-1], (1, 0), value= -math.inf)
+            values[:, feature_index] += torch.maximum(previous_values, moved_values)
+
+        paths = torch.zeros_like(values, dtype= dtype)   # Allocated in the result dtype, not int64 and a copy.
+        batch_indices = torch.arange(batch_size, device= values.device)
+        token_indices = token_lengths - 1   # [Batch]
+        for feature_index in range(feature_length - 1, -1, -1):
+            actives = feature_index < feature_lengths   # [Batch]
+            paths[batch_indices, feature_index, token_indices.clamp(min= 0)] = actives.to(dtype)
+            if feature_index == 0:
+                break
+            stayed_values = values[batch_indices, feature_index - 1, token_indices.clamp(min= 0)]
+            moved_values = values[batch_indices, feature_index - 1, (token_indices - 1).clamp(min= 0)]
+            moves = actives & (token_indices != 0) & ((token_indices == feature_index) | (stayed_values < moved_values))
+            token_indices = token_indices - moves.long()
+
+        return paths
+
+@jit(nopython= True, parallel= True)
+def Calc_Paths(paths, x, token_lengths, feature_lengths):
+    '''
+    paths: [Batch, Feature_t, Token_t], int32 zeros. The result is written here.
+    x: [Batch, Feature_t, Token_t], float32. Overwritten by the accumulated values.
+    '''
+    for batch_index in prange(x.shape[0]):
+        Calc_Path(paths[batch_index], x[batch_index], token_lengths[batch_index], feature_lengths[batch_index])
+
+@jit(nopython= True)
+def Calc_Path(path, x, token_length, feature_length):
+    for feature_index in range(feature_length):
+        for token_index in range(max(0, token_length + feature_index - feature_length), min(token_length, feature_index + 1)):
+            if feature_index == token_index:
+                current_q = -1e+9
+            else:
+                current_q = x[feature_index - 1, token_index]   # Stayed current token
+            if token_index == 0:
+                if feature_index == 0:
+                    prev_q = 0.0
                 else:
-                    prev_q = x[feature_index - 1, token_index - 1]  # Moved to next token
-                x[feature_index, token_index] = x[feature_index, token_index] + max(prev_q, current_q)
+                    prev_q = -1e+9
+            else:
+                prev_q = x[feature_index - 1, token_index - 1]  # Moved to next token
+            x[feature_index, token_index] = x[feature_index, token_index] + max(prev_q, current_q)
+
+    token_index = token_length - 1
+    for feature_index in range(feature_length - 1, -1, -1):
+        path[feature_index, token_index] = 1
+        if token_index != 0 and (token_index == feature_index or x[feature_index - 1, token_index] < x[feature_index - 1, token_index - 1]):
+            token_index = token_index - 1
+
+class Banded_Duration_Generator(torch.nn.Module):
+    def __init__(self, band_width: int, chunk_size: int= 128):
+        super().__init__()
+        self.band_width = band_width
+        self.chunk_size = chunk_size
 
-        token_index = token_length - 1
-        for feature_index in range(feature_length - 1, -1, -1):
-            path[feature_index, token_index] = 1
-            if token_index != 0 and token_index == feature_index or x[feature_index - 1, token_index] < x[feature_index - 1, token_index - 1]:
-                token_index = token_index - 1
+    @torch.no_grad()
+    def forward(self, features, means_p, log_stds_p, token_lengths, feature_lengths):
+        '''
+        features: [Batch, Feature_d, Feature_t]
+        means_p: [Batch, Feature_d, Token_t]
+        log_stds_p: [Batch, Feature_d, Token_t]
+        token_lengths: [Batch]
+        feature_lengths: [Batch]
+        Returns the durations [Batch, Token_t] of the monotonic alignment searched only in the band of
+        band_width tokens around the diagonal of each pattern. The scores are computed in frame chunks and stored as [Batch, Feature_t, Band],
+        so neither the dense [Batch, Feature_t, Token_t] scores nor the path matrix is generated.
+        '''
+        batch_size, _, feature_length = features.size()
+        token_length = means_p.size(2)
+        band_size = min(2 * self.band_width + 1, token_length)
+
+        frames = torch.arange(feature_length, device= features.device)[None, :]   # [1, Feature_t]
+        starts = frames * token_lengths[:, None] // feature_lengths[:, None] - self.band_width
+        starts = torch.minimum(starts.clamp(min= 0), (token_lengths[:, None] - band_size).clamp(min= 0))   # [Batch, Feature_t], non-decreasing
+        band_tokens = starts[:, :, None] + torch.arange(band_size, device= features.device)[None, None, :]    # [Batch, Feature_t, Band]
+        feasibles = \
+            (band_tokens < token_lengths[:, None, None]) & \
+            (band_tokens <= frames[:, :, None]) & \
+            (band_tokens >= token_lengths[:, None, None] + frames[:, :, None] - feature_lengths[:, None, None])    # [Batch, Feature_t, Band]
+
+        stds_p_sq_r = torch.exp(-2 * log_stds_p) # [Batch, Enc_d, Token_t]
+        neg_cent1 = torch.sum(-0.5 * math.log(2 * math.pi) - log_stds_p, [1], keepdim=True) # [Batch, 1, Token_t]
+        neg_cent4 = torch.sum(-0.5 * (means_p ** 2) * stds_p_sq_r, [1], keepdim=True) # [Batch, 1, Token_t]
+        neg_cent14 = neg_cent1 + neg_cent4
+        means_stds_p_sq_r = means_p * stds_p_sq_r
+
+        scores = []
+        for chunk_start in range(0, feature_length, self.chunk_size):
+            chunk_tokens = band_tokens[:, chunk_start:chunk_start + self.chunk_size].clamp(max= token_length - 1)    # [Batch, Chunk_t, Band]
+            window_starts = chunk_tokens[:, 0, 0]   # [Batch]
+            window_size = int((chunk_tokens[:, -1, -1] - window_starts).max()) + 1
+            window_tokens = (window_starts[:, None] + torch.arange(window_size, device= features.device)[None, :]).clamp(max= token_length - 1)  # [Batch, Window_t]
+            def Window(x: torch.Tensor):
+                return x.gather(2, window_tokens[:, None, :].expand(-1, x.size(1), -1))    # [Batch, Dim, Window_t]
+
+            chunk_features = features[:, :, chunk_start:chunk_start + self.chunk_size].permute(0, 2, 1)  # [Batch, Chunk_t, Feature_d]
+            neg_cent = \
+                Window(neg_cent14) + \
+                torch.matmul(-0.5 * chunk_features ** 2, Window(stds_p_sq_r)) + \
+                torch.matmul(chunk_features, Window(means_stds_p_sq_r))  # [Batch, Chunk_t, Window_t]
+            scores.append(neg_cent.gather(2, chunk_tokens - window_starts[:, None, None]))  # [Batch, Chunk_t, Band]
+        scores = torch.cat(scores, dim= 1).masked_fill(~feasibles, -1e+9)  # [Batch, Feature_t, Band]
+
+        durations = np.zeros((batch_size, token_length), dtype= np.int32)
+        Calc_Banded_Durations(
+            durations,
+            np.ascontiguousarray(scores.cpu().numpy(), dtype= np.float32),
+            starts.cpu().numpy().astype(np.int32),
+            token_lengths.cpu().numpy().astype(np.int32),
+            feature_lengths.cpu().numpy().astype(np.int32)
+            )
+
+        return torch.from_numpy(durations).to(device= features.device, dtype= torch.long)
 
-        return path
+@jit(nopython= True, parallel= True)
+def Calc_Banded_Durations(durations, x, starts, token_lengths, feature_lengths):
+    '''
+    durations: [Batch, Token_t], int32 zeros. The result is written here.
+    x: [Batch, Feature_t, Band], float32. Overwritten by the accumulated values.
+    starts: [Batch, Feature_t], the token index of the first band position of each frame.
+    '''
+    for batch_index in prange(x.shape[0]):
+        Calc_Banded_Duration(durations[batch_index], x[batch_index], starts[batch_index], token_lengths[batch_index], feature_lengths[batch_index])
+
+@jit(nopython= True)
+def Calc_Banded_Duration(duration, x, starts, token_length, feature_length):
+    band_size = x.shape[1]
+    for feature_index in range(1, feature_length):
+        for band_index in range(band_size):
+            previous_band_index = starts[feature_index] + band_index - starts[feature_index - 1]    # Same token at the previous frame
+            if previous_band_index < band_size:
+                current_q = x[feature_index - 1, previous_band_index]   # Stayed current token
+            else:
+                current_q = -1e+9
+            if previous_band_index > 0 and previous_band_index <= band_size:
+                prev_q = x[feature_index - 1, previous_band_index - 1]  # Moved to next token
+            else:
+                prev_q = -1e+9
+            x[feature_index, band_index] = x[feature_index, band_index] + max(prev_q, current_q)
+
+    token_index = token_length - 1
+    for feature_index in range(feature_length - 1, -1, -1):
+        duration[token_index] += 1
+        if feature_index == 0:
+            break
+        previous_band_index = token_index - starts[feature_index - 1]
+        if previous_band_index < band_size:
+            current_q = x[feature_index - 1, previous_band_index]
+        else:
+            current_q = -1e+9
+        if previous_band_index > 0 and previous_band_index <= band_size:
+            prev_q = x[feature_index - 1, previous_band_index - 1]
+        else:
+            prev_q = -1e+9
+        if token_index != 0 and (token_index == feature_index or current_q < prev_q):
+            token_index = token_index - 1
 
 def Mask_Generate(lengths: torch.Tensor, max_length: int= None):
     '''
@@ -1,13 +1,13 @@
 import torch
 import numpy as np
-import yaml, os, pickle, librosa, re, argparse, math
-from concurrent.futures import ThreadPoolExecutor as PE
+import yaml, os, pickle, librosa, re, argparse, math, zipfile, time
+from concurrent.futures import ProcessPoolExecutor as PE
 from random import shuffle
 from tqdm import tqdm
 import hgtk
 from pysptk.sptk import rapt
 
-from meldataset import mel_spectrogram, spectrogram, spec_energy
+from meldataset import spectrogram_mel_energy_batch
 from Arg_Parser import Recursive_Parse
 
 using_Extension = [x.upper() for x in ['.wav', '.m4a', '.flac']]
@@ -46,45 +46,65 @@ def Decompose(text):
 
     return decomposed
 
-def Pattern_Generate(
-    path,
-    n_fft: int,
-    num_mels: int,
-    sample_rate: int,
-    hop_size: int,
-    win_size: int,
-    fmin: int,
-    fmax: int,
-    f0_min: int,
-    f0_max: int,
-    center: bool= False,
-    top_db= 60
-    ):
+def Pattern_Save(path: str, pattern_dict: dict):
+    '''
+    A '.NPZ' path is saved as an uncompressed npz. Each array is a separate member which is decoded only when it is loaded,
+    and the other values are pickled together in '__Values__'. The other paths are saved as a pickle.
+    '''
+    temp_path = '{}.{}.TMP'.format(path, os.getpid())   # Renamed after writing, so a stopped generation leaves no partial pattern.
+    if os.path.splitext(path)[1].upper() == '.NPZ':
+        arrays = {key: value for key, value in pattern_dict.items() if isinstance(value, np.ndarray)}
+        values = {key: value for key, value in pattern_dict.items() if not isinstance(value, np.ndarray)}
+        with open(temp_path, 'wb') as f:
+            np.savez(f, __Values__= np.frombuffer(pickle.dumps(values, protocol= 4), dtype= np.uint8), **arrays)
+    else:
+        with open(temp_path, 'wb') as f:
+            pickle.dump(pattern_dict, f, protocol= 4)
+    os.replace(temp_path, path)
+
+def Pattern_Load(path: str, keys: list= None):
+    '''
+    keys: the keys to load. None loads all keys.
+    From a '.NPZ' pattern, only the arrays of the keys are read. A pickle pattern is always read whole.
+    '''
+    if os.path.splitext(path)[1].upper() == '.NPZ':
+        with np.load(path) as npz:
+            pattern_dict = pickle.loads(npz['__Values__'].tobytes())
+            for key in (keys or npz.files):
+                if key in npz.files and key != '__Values__':
+                    pattern_dict[key] = npz[key]
+    else:
+        pattern_dict = pickle.load(open(path, 'rb'))
+
+    if not keys is None:
+        pattern_dict = {key: pattern_dict[key] for key in keys if key in pattern_dict}  # Missing keys like 'Token' of old patterns are skipped.
+
+    return pattern_dict
+
+def Pattern_Load_Size(path: str, keys: list= None):
+    '''
+    The bytes which Pattern_Load reads for the keys, without reading the pattern.
+    '''
+    if os.path.splitext(path)[1].upper() != '.NPZ' or keys is None:
+        return os.path.getsize(path)
+
+    with zipfile.ZipFile(path) as npz:
+        return sum([
+            info.compress_size
+            for info in npz.infolist()
+            if os.path.splitext(info.filename)[0] in ['__Values__'] + list(keys)
+            ])
 
+def Audio_Load(path, sample_rate: int, hop_size: int, top_db= 60):
     audio, _ = librosa.load(path, sr= sample_rate)
     audio = librosa.effects.trim(audio, top_db=top_db, frame_length= 512, hop_length= 256)[0]
     audio = librosa.util.normalize(audio) * 0.95
     audio = audio[:audio.shape[0] - (audio.shape[0] % hop_size)]
-    spect = spectrogram(
-        y= torch.from_numpy(audio).float().unsqueeze(0),
-        n_fft= n_fft,
-        hop_size= hop_size,
-        win_size= win_size,
-        center= center
-        ).squeeze(0).T.numpy()
-    mel = mel_spectrogram(
-        y= torch.from_numpy(audio).float().unsqueeze(0),
-        n_fft= n_fft,
-        num_mels= num_mels,
-        sampling_rate= sample_rate,
-        hop_size= hop_size,
-        win_size= win_size,
-        fmin= fmin,
-        fmax= fmax,
-        center= center
-        ).squeeze(0).T.numpy()
-
-    log_f0 = rapt(
+
+    return audio
+
+def Log_F0_Generate(audio, sample_rate: int, hop_size: int, f0_min: int, f0_max: int):
+    return rapt(
         x= audio * 32768,
         fs= sample_rate,
         hopsize= hop_size,
@@ -93,47 +113,27 @@ def Pattern_Generate(
         otype= 2    # log
         )
 
-    energy = spec_energy(
-        y= torch.from_numpy(audio).float().unsqueeze(0),
-        n_fft= n_fft,
-        hop_size= hop_size,
-        win_size= win_size,
-        center= center
-        ).squeeze(0).numpy()
-
-    if log_f0.shape[0] != mel.shape[0]:
-        print(path, audio.shape[0], log_f0.shape[0], mel.shape[0])
-
-    return audio, spect, mel, log_f0, energy
-
-def Pattern_File_Generate(path, speaker, emotion, language, gender, dataset, text, decomposed, tag='', eval= False):
+def Pattern_File_Path(path, speaker, dataset, tag='', eval= False):
+    '''
+    Returns the pattern file path, or None when the pattern is already generated in the train or eval pattern path.
+    '''
     pattern_path = hp.Train.Eval_Pattern.Path if eval else hp.Train.Train_Pattern.Path
 
-    file = '{}.{}{}.PICKLE'.format(
+    file = '{}.{}{}.{}'.format(
         speaker if dataset in speaker else '{}.{}'.format(dataset, speaker),
         '{}.'.format(tag) if tag != '' else '',
-        os.path.splitext(os.path.basename(path))[0]
+        os.path.splitext(os.path.basename(path))[0],
+        'NPZ' if hp.Train.Pattern_Format == 'NPZ' else 'PICKLE'
         ).upper()
     if any([
         os.path.exists(os.path.join(x, dataset, speaker, file).replace("\\", "/"))
         for x in [hp.Train.Eval_Pattern.Path, hp.Train.Train_Pattern.Path]
         ]):
-        return
-    file = os.path.join(pattern_path, dataset, speaker, file).replace("\\", "/")
+        return None  # Already generated. This makes a stopped generation resumable.
 
-    audio, spect, mel, log_f0, energy = Pattern_Generate(
-        path= path,
-        n_fft= hp.Sound.N_FFT,
-        num_mels= hp.Sound.Mel_Dim,
-        sample_rate= hp.Sound.Sample_Rate,
-        hop_size= hp.Sound.Frame_Shift,
-        win_size= hp.Sound.Frame_Length,
-        fmin= hp.Sound.Mel_F_Min,
-        fmax= hp.Sound.Mel_F_Max,
-        f0_min= hp.Sound.F0_Min,
-        f0_max= hp.Sound.F0_Max,
-        top_db= top_db_dict[dataset] if dataset in top_db_dict.keys() else 60
-        )
+    return os.path.join(pattern_path, dataset, speaker, file).replace("\\", "/")
+
+def Pattern_File_Save(file, audio, spect, mel, log_f0, energy, speaker, emotion, language, gender, dataset, text, decomposed):
     new_Pattern_dict = {
         'Audio': audio.astype(np.float32),
         'Spectrogram': spect.astype(np.float32),
@@ -146,12 +146,73 @@ def Pattern_File_Generate(path, speaker, emotion, language, gender, dataset, tex
         'Gender': gender,
         'Dataset': dataset,
         'Text': text,
-        'Decomposed': decomposed
+        'Decomposed': decomposed,
+        'Token': np.array([token_dict[letter] for letter in ['<S>'] + list(decomposed) + ['<E>']], dtype= np.int16)
         }
 
-    os.makedirs(os.path.join(pattern_path, dataset, speaker).replace('\\', '/'), exist_ok= True)
-    with open(file, 'wb') as f:
-        pickle.dump(new_Pattern_dict, f, protocol=4)
+    os.makedirs(os.path.dirname(file), exist_ok= True)
+    Pattern_Save(file, new_Pattern_dict)
+
+    return audio.shape[0] / hp.Sound.Sample_Rate
+
+def Pattern_File_Generate_Batch(params_list):
+    '''
+    params_list: a list of (path, speaker, emotion, language, gender, dataset, text, decomposed, tag, eval).
+    The spectrograms, mels and energies of the not generated patterns are extracted together by spectrogram_mel_energy_batch
+    on the device of the process. Returns the audio seconds of each params, 0.0 for the skipped patterns.
+    '''
+    audio_times = [0.0] * len(params_list)
+    indices, files, audios = [], [], []
+    for index, (path, speaker, _, _, _, dataset, _, _, tag, eval) in enumerate(params_list):
+        file = Pattern_File_Path(path, speaker, dataset, tag, eval)
+        if file is None:
+            continue
+        indices.append(index)
+        files.append(file)
+        audios.append(Audio_Load(
+            path= path,
+            sample_rate= hp.Sound.Sample_Rate,
+            hop_size= hp.Sound.Frame_Shift,
+            top_db= top_db_dict[dataset] if dataset in top_db_dict.keys() else 60
+            ))
+    if len(audios) == 0:
+        return audio_times
+
+    specs, mels, energies = spectrogram_mel_energy_batch(
+        ys= audios,
+        n_fft= hp.Sound.N_FFT,
+        num_mels= hp.Sound.Mel_Dim,
+        sampling_rate= hp.Sound.Sample_Rate,
+        hop_size= hp.Sound.Frame_Shift,
+        win_size= hp.Sound.Frame_Length,
+        fmin= hp.Sound.Mel_F_Min,
+        fmax= hp.Sound.Mel_F_Max,
+        device= device
+        )
+
+    for index, file, audio, spect, mel, energy in zip(indices, files, audios, specs, mels, energies):
+        path, speaker, emotion, language, gender, dataset, text, decomposed, _, _ = params_list[index]
+        log_f0 = Log_F0_Generate(audio, hp.Sound.Sample_Rate, hp.Sound.Frame_Shift, hp.Sound.F0_Min, hp.Sound.F0_Max)
+        if log_f0.shape[0] != mel.shape[1]:
+            print(path, audio.shape[0], log_f0.shape[0], mel.shape[1])
+        audio_times[index] = Pattern_File_Save(
+            file, audio, spect.T.numpy(), mel.T.numpy(), log_f0, energy.numpy(),
+            speaker, emotion, language, gender, dataset, text, decomposed
+            )
+
+    return audio_times
+
+def Worker_Initialize(hyper_parameters, token_dict_, device_= 'cpu'):
+    '''
+    Sets the globals of a pattern generation process.
+    The globals live as long as the process, so the get_mel_basis / get_hann_window cache of meldataset
+    is filled once per process and device and is shared by all its patterns.
+    '''
+    global hp, token_dict, device
+    hp = hyper_parameters
+    token_dict = token_dict_
+    device = device_
+    torch.set_num_threads(1)    # The processes already use all cores.
 
 
 def Emotion_Info_Load(path):
@@ -702,6 +763,7 @@ def Metadata_Generate(eval= False):
         'Dataset_Dict': {},
         'File_List_by_Speaker_Dict': {},
         'Text_Length_Dict': {},
+        'Feature_Range_Dict': {},
         }
 
     files_TQDM = tqdm(
@@ -711,12 +773,10 @@ def Metadata_Generate(eval= False):
 
     for root, _, files in os.walk(pattern_path, followlinks=True):
         for file in files:
-            with open(os.path.join(root, file).replace("\\", "/"), "rb") as f:
-                pattern_dict = pickle.load(f)
-
             file = os.path.join(root, file).replace("\\", "/").replace(pattern_path, '').lstrip('/')
 
             try:
+                pattern_dict = Pattern_Load(os.path.join(pattern_path, file).replace("\\", "/"))
                 if not all([
                     key in pattern_dict.keys()
                     for key in ('Audio', 'Spectrogram', 'Mel', 'Log_F0', 'Energy', 'Speaker', 'Emotion', 'Language', 'Gender', 'Dataset', 'Text', 'Decomposed')
@@ -765,6 +825,14 @@ def Metadata_Generate(eval= False):
 
             files_TQDM.update(1)
 
+    new_Metadata_dict['Feature_Range_Dict'] = {
+        feature: {
+            'Min': min([value['Min'] for value in range_dict.values()], default= math.inf),
+            'Max': max([value['Max'] for value in range_dict.values()], default= -math.inf)
+            }
+        for feature, range_dict in [('Spectrogram', spectrogram_range_dict), ('Mel', mel_range_dict)]
+        }   # The normalization constants of Dataset, same to the range info. Pattern_Store.py normalizes both stores by the train constants.
+
     with open(os.path.join(pattern_path, metadata_File.upper()).replace("\\", "/"), 'wb') as f:
         pickle.dump(new_Metadata_dict, f, protocol= 4)
 
@@ -876,7 +944,9 @@ if __name__ == '__main__':
 
     argParser.add_argument("-evalr", "--eval_ratio", default= 0.001, type= float)
     argParser.add_argument("-evalm", "--eval_min", default= 1, type= int)
-    argParser.add_argument("-mw", "--max_worker", default= 2, required=False, type= int)
+    argParser.add_argument("-mw", "--max_worker", default= os.cpu_count(), required=False, type= int)
+    argParser.add_argument("-cs", "--chunk_size", default= 16, required=False, type= int)   # Files of a feature extraction batch.
+    argParser.add_argument("-device", "--device", default= 'cpu', required=False, type= str)    # e.g. 'cuda:0'. Use a small max_worker with a gpu.
 
     args = argParser.parse_args()
 
@@ -989,51 +1059,52 @@ if __name__ == '__main__':
 
     token_dict = Token_dict_Generate()
 
-    with PE(max_workers = args.max_worker) as pe:
-        for _ in tqdm(
-            pe.map(
-                lambda params: Pattern_File_Generate(*params),
-                [
-                    (
-                        path,
-                        speaker_dict[path],
-                        emotion_dict[path],
-                        language_dict[path],
-                        gender_dict[path],
-                        dataset_dict[path],
-                        text_dict[path],
-                        decomposed_dict[path],
-                        tag_dict[path],
-                        False
-                        )
-                    for path in train_paths
-                    ]
-                ),
-            total= len(train_paths)
-            ):
-            pass
-        for _ in tqdm(
-            pe.map(
-                lambda params: Pattern_File_Generate(*params),
+    with PE(
+        max_workers= args.max_worker,
+        initializer= Worker_Initialize,
+        initargs= (hp, token_dict, args.device)
+        ) as pe:
+        for paths, eval in [(train_paths, False), (eval_paths, True)]:
+            start_time = time.perf_counter()
+            generated_count, generated_audio_time = 0, 0.0
+            params_list = [
+                (
+                    path,
+                    speaker_dict[path],
+                    emotion_dict[path],
+                    language_dict[path],
+                    gender_dict[path],
+                    dataset_dict[path],
+                    text_dict[path],
+                    decomposed_dict[path],
+                    tag_dict[path],
+                    eval
+                    )
+                for path in paths
+                ]
+            chunk_size = max(1, min(args.chunk_size, len(paths) // (args.max_worker * 4)))   # A small split is still spread to all workers.
+            progress_bar = tqdm(total= len(paths))
+            for audio_times in pe.map(
+                Pattern_File_Generate_Batch,
                 [
-                    (
-                        path,
-                        speaker_dict[path],
-                        emotion_dict[path],
-                        language_dict[path],
-                        gender_dict[path],
-                        dataset_dict[path],
-                        text_dict[path],
-                        decomposed_dict[path],
-                        tag_dict[path],
-                        True
-                        )
-                    for path in eval_paths
+                    params_list[index:index + chunk_size]
+                    for index in range(0, len(params_list), chunk_size)
                     ]
-                ),
-            total= len(eval_paths)
-            ):
-            pass
+                ):
+                for audio_time in audio_times:
+                    if audio_time > 0.0:
+                        generated_count += 1
+                        generated_audio_time += audio_time
+                progress_bar.update(len(audio_times))
+            progress_bar.close()
+            elapsed_time = time.perf_counter() - start_time
+            print('{} patterns: {} generated, {} skipped, {:.2f} files/sec, {:.4f} audio hours/sec'.format(
+                'Eval' if eval else 'Train',
+                generated_count,
+                len(paths) - generated_count,
+                generated_count / max(elapsed_time, 1e-9),
+                generated_audio_time / 3600.0 / max(elapsed_time, 1e-9)
+                ))
 
     Metadata_Generate()
     Metadata_Generate(eval= True)
\ No newline at end of file
@@ -0,0 +1,193 @@
+import numpy as np
+import yaml, os, pickle, argparse
+from tqdm import tqdm
+from typing import Dict, List, Optional
+
+from Pattern_Generator import Pattern_Load
+from Arg_Parser import Recursive_Parse
+
+class Pattern_Store:
+    '''
+    A packed pattern store. Each feature is written to the contiguous [Frame, Dim] .npy shards,
+    and INDEX.PICKLE has the (shard, offset, length) of each pattern and the other small values like 'Decomposed'.
+    The shards are memory-mapped when they are used first, so each DataLoader worker opens each shard only once
+    and a feature is read as a view without unpickling the whole pattern.
+    When the store is generated with the feature ranges, the features are stored already normalized to [-1, 1]
+    and the constants are in 'Normalization'.
+    '''
+    def __init__(self, path: str):
+        self.path = path
+        self.index_dict = pickle.load(open(
+            os.path.join(path, 'INDEX.PICKLE').replace('\\', '/'), 'rb'
+            ))
+        self.shard_dict = {}
+
+    def Shard(self, feature: str, shard_index: int):
+        key = (feature, shard_index)
+        if not key in self.shard_dict:
+            self.shard_dict[key] = np.load(
+                os.path.join(self.path, self.index_dict['Features'][feature]['Shards'][shard_index]).replace('\\', '/'),
+                mmap_mode= 'r'
+                )
+
+        return self.shard_dict[key]
+
+    def Get(self, key: str, feature: str):
+        '''
+        key: the pattern path in the metadata.
+        Returns a read-only view [Time, Dim] of the feature.
+        '''
+        shard_index, offset, length = self.index_dict['Features'][feature]['Index'][key]
+
+        return self.Shard(feature, shard_index)[offset:offset + length]
+
+    def Get_Value(self, key: str, name: str):
+        return self.index_dict['Values'][name][key]
+
+    def Has_Value(self, name: str):
+        return name in self.index_dict['Values']
+
+    def Get_Normalization(self, feature: str):
+        '''
+        Returns (min, max) which normalized the feature, or None when the feature is stored raw.
+        '''
+        return self.index_dict.get('Normalization', {}).get(feature, None)
+
+    def __contains__(self, key: str):
+        return key in self.index_dict['Keys']
+
+    def __getstate__(self):
+        state_dict = self.__dict__.copy()
+        state_dict['shard_dict'] = {}   # The memory maps are not sent to the workers.
+        return state_dict
+
+def Pattern_Store_Generate(
+    pattern_path: str,
+    metadata_file: str,
+    store_path: str,
+    features: List[str]= ['Mel', 'Spectrogram'],
+    values: List[str]= ['Decomposed', 'Text', 'Speaker'],
+    dtype: str= 'float32',
+    shard_frames: int= 2 ** 22,
+    token_dict: Optional[Dict[str, int]]= None,
+    feature_range_dict: Optional[Dict[str, Dict[str, float]]]= None
+    ):
+    '''
+    Converts a pattern folder of the pickles to a Pattern_Store.
+    The shards are allocated from the lengths of the metadata, so each pickle is read only once.
+    token_dict: when given, the int16 tokens are stored as the value 'Token'.
+    feature_range_dict: {feature: {'Min': min, 'Max': max}}. When given, the features are stored normalized by them.
+    '''
+    metadata_dict = pickle.load(open(
+        os.path.join(pattern_path, metadata_file).replace('\\', '/'), 'rb'
+        ))
+    length_dict_by_feature = {
+        'Audio': metadata_dict['Audio_Length_Dict'],
+        'Spectrogram': metadata_dict['Spectrogram_Length_Dict'],
+        'Mel': metadata_dict['Mel_Length_Dict'],
+        'Log_F0': metadata_dict['F0_Length_Dict'],
+        'Energy': metadata_dict['Energy_Length_Dict'],
+        }
+    files = metadata_dict['File_List']
+    os.makedirs(store_path, exist_ok= True)
+
+    index_dict = {
+        'Keys': set(files),
+        'Features': {},
+        'Values': {name: {} for name in values + (['Token'] if not token_dict is None else [])},
+        'Normalization': {
+            feature: (range_dict['Min'], range_dict['Max'])
+            for feature, range_dict in (feature_range_dict or {}).items()
+            if feature in features
+            }
+        }
+    shards_by_feature = {}
+    for feature in features:
+        index_dict['Features'][feature] = {'Shards': [], 'Index': {}}
+        shard_lengths = [0]
+        for file in files:
+            length = length_dict_by_feature[feature][file]
+            if shard_lengths[-1] > 0 and shard_lengths[-1] + length > shard_frames:
+                shard_lengths.append(0)
+            index_dict['Features'][feature]['Index'][file] = (len(shard_lengths) - 1, shard_lengths[-1], length)
+            shard_lengths[-1] += length
+        index_dict['Features'][feature]['Shards'] = [
+            '{}.{:03d}.NPY'.format(feature.upper(), shard_index)
+            for shard_index in range(len(shard_lengths))
+            ]
+        shards_by_feature[feature] = shard_lengths
+
+    shard_dict = {}
+    for file in tqdm(files, desc= os.path.basename(store_path)):
+        pattern_dict = Pattern_Load(
+            os.path.join(pattern_path, file).replace('\\', '/'),
+            keys= features + values
+            )
+        for feature in features:
+            shard_index, offset, length = index_dict['Features'][feature]['Index'][file]
+            if not (feature, shard_index) in shard_dict:
+                shard_dict[feature, shard_index] = np.lib.format.open_memmap(
+                    os.path.join(store_path, index_dict['Features'][feature]['Shards'][shard_index]).replace('\\', '/'),
+                    mode= 'w+',
+                    dtype= dtype,
+                    shape= (shards_by_feature[feature][shard_index],) + pattern_dict[feature].shape[1:]
+                    )
+            pattern = pattern_dict[feature]
+            if feature in index_dict['Normalization']:
+                feature_min, feature_max = index_dict['Normalization'][feature]
+                pattern = (pattern - feature_min) / (feature_max - feature_min) * 2.0 - 1.0
+            shard_dict[feature, shard_index][offset:offset + length] = pattern
+        for name in values:
+            index_dict['Values'][name][file] = pattern_dict[name]
+        if not token_dict is None:
+            index_dict['Values']['Token'][file] = np.array([
+                token_dict[letter]
+                for letter in ['<S>'] + list(pattern_dict['Decomposed']) + ['<E>']
+                ], dtype= np.int16)
+
+    for shard in shard_dict.values():
+        shard.flush()
+    with open(os.path.join(store_path, 'INDEX.PICKLE').replace('\\', '/'), 'wb') as f:
+        pickle.dump(index_dict, f, protocol= 4)
+
+if __name__ == '__main__':
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument('-hp', '--hyper_parameters', required= True, type= str)
+    argParser.add_argument('-f', '--features', nargs= '+', default= ['Mel', 'Spectrogram'], type= str)
+    argParser.add_argument('-dtype', '--dtype', default= 'float32', type= str)
+    argParser.add_argument('-sf', '--shard_frames', default= 2 ** 22, type= int)
+    args = argParser.parse_args()
+
+    hp = Recursive_Parse(yaml.load(
+        open(args.hyper_parameters, encoding='utf-8'),
+        Loader=yaml.Loader
+        ))
+
+    token_dict = yaml.load(open(hp.Token_Path), Loader=yaml.Loader)
+    train_metadata_dict = pickle.load(open(
+        os.path.join(hp.Train.Train_Pattern.Path, hp.Train.Train_Pattern.Metadata_File).replace('\\', '/'), 'rb'
+        ))
+    if 'Feature_Range_Dict' in train_metadata_dict:
+        feature_range_dict = train_metadata_dict['Feature_Range_Dict']  # Both stores are normalized by the train constants like Dataset.
+    else:   # The metadata is generated before the constants were recorded.
+        feature_range_dict = {}
+        for feature, range_info_path in [('Spectrogram', hp.Spectrogram_Range_Info_Path), ('Mel', hp.Mel_Range_Info_Path)]:
+            range_info_dict = yaml.load(open(range_info_path), Loader=yaml.Loader)
+            feature_range_dict[feature] = {
+                'Min': min([value['Min'] for value in range_info_dict.values()]),
+                'Max': max([value['Max'] for value in range_info_dict.values()])
+                }   # Same to the constants of Dataset.
+
+    for pattern_info in [hp.Train.Train_Pattern, hp.Train.Eval_Pattern]:
+        if pattern_info.Store_Path is None:
+            continue
+        Pattern_Store_Generate(
+            pattern_path= pattern_info.Path,
+            metadata_file= pattern_info.Metadata_File,
+            store_path= pattern_info.Store_Path,
+            features= args.features,
+            dtype= args.dtype,
+            shard_frames= args.shard_frames,
+            token_dict= token_dict,
+            feature_range_dict= feature_range_dict
+            )
@@ -14,7 +14,7 @@ from scipy.io import wavfile
 
 from Modules.Modules import GradTTS, Mask_Generate, MLE_Loss
 
-from Datasets import Dataset, Inference_Dataset, Collater, Inference_Collater
+from Datasets import Dataset, Inference_Dataset, Collater, Inference_Collater, Duration_Cache, Pattern_Cache, Bucket_Batch_Sampler
 from Noam_Scheduler import Noam_Scheduler
 from Logger import Logger
 
@@ -90,6 +90,17 @@ class Trainer:
         self.feature_min = min([value['Min'] for value in feature_range_info_dict.values()])
         self.feature_max = max([value['Max'] for value in feature_range_info_dict.values()])
 
+        pattern_cache_dict = {'Train': None, 'Eval': None}
+        if self.hp.Train.Use_Pattern_Cache:
+            pattern_cache_dict = {
+                key: Pattern_Cache(
+                    path= self.hp.Train.Pattern_Cache.Path,
+                    namespace= '{}/{}/{}/{}'.format(pattern_info.Path, self.hp.Feature_Type, self.feature_min, self.feature_max),  # A new range info makes a new namespace.
+                    max_bytes= int(self.hp.Train.Pattern_Cache.Size * 1024 ** 3)
+                    )
+                for key, pattern_info in [('Train', self.hp.Train.Train_Pattern), ('Eval', self.hp.Train.Eval_Pattern)]
+                }
+
         train_dataset = Dataset(
             token_dict= token_dict,
             feature_range_info_dict= feature_range_info_dict,
@@ -101,7 +112,9 @@ class Trainer:
             text_length_min= self.hp.Train.Train_Pattern.Text_Length.Min,
             text_length_max= self.hp.Train.Train_Pattern.Text_Length.Max,
             accumulated_dataset_epoch= self.hp.Train.Train_Pattern.Accumulated_Dataset_Epoch,
-            augmentation_ratio= self.hp.Train.Train_Pattern.Augmentation_Ratio
+            augmentation_ratio= self.hp.Train.Train_Pattern.Augmentation_Ratio,
+            store_path= self.hp.Train.Train_Pattern.Store_Path,
+            pattern_cache= pattern_cache_dict['Train']
             )
         eval_dataset = Dataset(
             token_dict= token_dict,
@@ -112,8 +125,18 @@ class Trainer:
             feature_length_min= max(self.hp.Train.Segment_Size, self.hp.Train.Eval_Pattern.Feature_Length.Min),
             feature_length_max= self.hp.Train.Eval_Pattern.Feature_Length.Max,
             text_length_min= self.hp.Train.Eval_Pattern.Text_Length.Min,
-            text_length_max= self.hp.Train.Eval_Pattern.Text_Length.Max
+            text_length_max= self.hp.Train.Eval_Pattern.Text_Length.Max,
+            store_path= self.hp.Train.Eval_Pattern.Store_Path,
+            pattern_cache= pattern_cache_dict['Eval']
             )
+        self.duration_cache = None
+        if self.hp.Train.Duration_Cache.Use:
+            self.duration_cache = Duration_Cache(
+                path= os.path.join(self.hp.Train.Duration_Cache.Path, 'Rank_{}'.format(self.gpu_id)).replace('\\', '/'),
+                pattern_keys= train_dataset.pattern_keys,
+                max_token_length= self.hp.Train.Duration_Cache.Max_Token_Length,
+                refresh_interval= self.hp.Train.Duration_Cache.Refresh_Interval
+                )
         inference_dataset = Inference_Dataset(
             token_dict= token_dict,
             texts= self.hp.Train.Inference_in_Train.Text,
@@ -123,6 +146,9 @@ class Trainer:
             logging.info('The number of train patterns = {}.'.format(len(train_dataset) // self.hp.Train.Train_Pattern.Accumulated_Dataset_Epoch))
             logging.info('The number of development patterns = {}.'.format(len(eval_dataset)))
             logging.info('The number of inference patterns = {}.'.format(len(inference_dataset)))
+            whole_size, loaded_size = train_dataset.IO_Report()
+            if not whole_size is None:
+                logging.info('Per-sample I/O of train patterns = {:.1f} KB ({:.1f} KB in the files).'.format(loaded_size / 1024, whole_size / 1024))
 
         collater = Collater(
             token_dict= token_dict
@@ -132,16 +158,33 @@ class Trainer:
             )
 
         self.dataloader_dict = {}
-        self.dataloader_dict['Train'] = torch.utils.data.DataLoader(
-            dataset= train_dataset,
-            sampler= torch.utils.data.DistributedSampler(train_dataset, shuffle= True) \
-                     if self.hp.Use_Multi_GPU else \
-                     torch.utils.data.RandomSampler(train_dataset),
-            collate_fn= collater,
-            batch_size= self.hp.Train.Batch_Size,
-            num_workers= self.hp.Train.Num_Workers,
-            pin_memory= True
-            )
+        if self.hp.Train.Bucketing.Use:
+            self.dataloader_dict['Train'] = torch.utils.data.DataLoader(
+                dataset= train_dataset,
+                batch_sampler= Bucket_Batch_Sampler(
+                    lengths= train_dataset.feature_lengths,
+                    batch_size= self.hp.Train.Batch_Size,
+                    frame_budget= self.hp.Train.Bucketing.Frame_Budget,
+                    pool_size= self.hp.Train.Bucketing.Pool_Size,
+                    shuffle= True,
+                    num_replicas= self.num_gpus if self.hp.Use_Multi_GPU else 1,
+                    rank= self.gpu_id if self.hp.Use_Multi_GPU else 0
+                    ),
+                collate_fn= collater,
+                num_workers= self.hp.Train.Num_Workers,
+                pin_memory= True
+                )
+        else:
+            self.dataloader_dict['Train'] = torch.utils.data.DataLoader(
+                dataset= train_dataset,
+                sampler= torch.utils.data.DistributedSampler(train_dataset, shuffle= True) \
+                         if self.hp.Use_Multi_GPU else \
+                         torch.utils.data.RandomSampler(train_dataset),
+                collate_fn= collater,
+                batch_size= self.hp.Train.Batch_Size,
+                num_workers= self.hp.Train.Num_Workers,
+                pin_memory= True
+                )
         self.dataloader_dict['Eval'] = torch.utils.data.DataLoader(
             dataset= eval_dataset,
             sampler= torch.utils.data.DistributedSampler(eval_dataset, shuffle= True) \
@@ -188,19 +231,30 @@ class Trainer:
         if self.gpu_id == 0:
             logging.info(self.model)
 
-    def Train_Step(self, tokens, token_lengths, features, feature_lengths):
+    def Train_Step(self, tokens, token_lengths, features, feature_lengths, pattern_indices):
         loss_dict = {}
         tokens = tokens.to(self.device, non_blocking=True)
         token_lengths = token_lengths.to(self.device, non_blocking=True)
         features = features.to(self.device, non_blocking=True)
         feature_lengths = feature_lengths.to(self.device, non_blocking=True)
 
+        cached_durations = None
+        if not self.duration_cache is None and self.steps >= self.hp.Train.Duration_Cache.Start_Step:
+            cached_durations = self.duration_cache.Get(
+                indices= pattern_indices.numpy(),
+                step= self.steps,
+                token_length= tokens.size(1)
+                )
+            if not cached_durations is None:
+                cached_durations = torch.from_numpy(cached_durations).to(self.device, non_blocking=True)
+
         with torch.cuda.amp.autocast(enabled= self.hp.Use_Mixed_Precision):
             predictions, noises, epsilons, log_duration_predictions, means_p, log_stds_p, durations = self.model(
                 tokens= tokens,
                 token_lengths= token_lengths,
                 features= features,
-                feature_lengths= feature_lengths
+                feature_lengths= feature_lengths,
+                durations= cached_durations
                 )
 
             token_masks = Mask_Generate(
@@ -243,17 +297,30 @@ class Trainer:
         self.steps += 1
         self.tqdm.update(1)
 
+        if not self.duration_cache is None and self.steps > self.hp.Train.Duration_Cache.Start_Step and cached_durations is None:
+            self.duration_cache.Set(
+                indices= pattern_indices.numpy(),
+                durations= durations.cpu().numpy(),
+                step= self.steps
+                )
+
         for tag, loss in loss_dict.items():
             loss = reduce_tensor(loss.data, self.num_gpus).item() if self.num_gpus > 1 else loss.item()
             self.scalar_dict['Train']['Loss/{}'.format(tag)] += loss
+        self.scalar_dict['Train']['Padding_Efficiency'] += (feature_lengths.sum() / (feature_lengths.max() * feature_lengths.size(0))).item()
+        if not self.duration_cache is None:
+            self.scalar_dict['Train']['Duration_Cache_Hit'] += float(not cached_durations is None)
 
     def Train_Epoch(self):
-        for tokens, token_lengths, features, feature_lengths in self.dataloader_dict['Train']:
+        if self.hp.Train.Bucketing.Use:
+            self.dataloader_dict['Train'].batch_sampler.set_epoch(self.steps)    # The steps are same in all ranks.
+        for tokens, token_lengths, features, feature_lengths, pattern_indices in self.dataloader_dict['Train']:
             self.Train_Step(
                 tokens= tokens,
                 token_lengths= token_lengths,
                 features= features,
-                feature_lengths= feature_lengths
+                feature_lengths= feature_lengths,
+                pattern_indices= pattern_indices
                 )
 
             if self.steps % self.hp.Train.Checkpoint_Save_Interval == 0:
@@ -332,7 +399,7 @@ class Trainer:
 
         self.model.eval()
 
-        for step, (tokens, token_lengths, features, feature_lengths) in tqdm(
+        for step, (tokens, token_lengths, features, feature_lengths, _) in tqdm(
             enumerate(self.dataloader_dict['Eval'], 1),
             desc='[Evaluation]',
             total= math.ceil(len(self.dataloader_dict['Eval'].dataset) / self.hp.Train.Batch_Size / self.num_gpus)
@@ -583,6 +650,8 @@ class Trainer:
         checkpoint_path = os.path.join(self.hp.Checkpoint_Path, 'S_{}.pt'.format(self.steps).replace('\\', '/'))
 
         torch.save(state_dict, checkpoint_path)
+        if not self.duration_cache is None:
+            self.duration_cache.Flush()
 
         logging.info('Checkpoint saved at {} steps.'.format(self.steps))
 
@@ -26,6 +26,7 @@ import math
 import os
 import random
 import logging
+import threading
 import torch
 import torch.utils.data
 import numpy as np
@@ -69,6 +70,64 @@ def spectral_de_normalize_torch(magnitudes):
 
 mel_basis = {}
 hann_window = {}
+cache_lock = threading.Lock()
+cache_counter = {'hits': 0, 'misses': 0}
+
+frequency_warp_matrix = {}
+frequency_warp_matrix_max_size = 32    # Random alphas make many keys, and a [F, F] matrix of n_fft 1024 is 1MB.
+
+def _cached(cache, key, generate, max_size=None):
+    with cache_lock:
+        if key in cache:
+            cache_counter['hits'] += 1
+        else:
+            cache_counter['misses'] += 1
+            if not max_size is None and len(cache) >= max_size:
+                del cache[next(iter(cache))]    # The oldest entry.
+            cache[key] = generate()
+
+        return cache[key]
+
+def get_mel_basis(sampling_rate, n_fft, num_mels, fmin, fmax, device, dtype=torch.float32):
+    '''
+    Returns the librosa mel filterbank [Num_Mels, N_FFT // 2 + 1] of the parameters on the device.
+    It is generated once per (sampling_rate, n_fft, num_mels, fmin, fmax, device, dtype) and shared by all extractors and threads.
+    '''
+    device = torch.device(device)
+    return _cached(
+        mel_basis,
+        (sampling_rate, n_fft, num_mels, fmin, fmax, str(device), dtype),
+        lambda: torch.from_numpy(librosa_mel_fn(sr=sampling_rate, n_fft=n_fft, n_mels=num_mels, fmin=fmin, fmax=fmax)).to(device=device, dtype=dtype)
+        )
+
+def get_hann_window(win_size, device, dtype=torch.float32):
+    device = torch.device(device)
+    return _cached(
+        hann_window,
+        (win_size, str(device), dtype),
+        lambda: torch.hann_window(win_size, device=device, dtype=dtype)
+        )
+
+def cache_info():
+    '''
+    Returns the hit and miss counts and the sizes of the mel basis and window caches.
+    '''
+    with cache_lock:
+        return {
+            'hits': cache_counter['hits'],
+            'misses': cache_counter['misses'],
+            'mel_basis': len(mel_basis),
+            'hann_window': len(hann_window),
+            'frequency_warp_matrix': len(frequency_warp_matrix)
+            }
+
+def cache_clear():
+    with cache_lock:
+        mel_basis.clear()
+        hann_window.clear()
+        frequency_warp_matrix.clear()
+        cache_counter['hits'] = 0
+        cache_counter['misses'] = 0
 
 def mel_spectrogram(y, n_fft, num_mels, sampling_rate, hop_size, win_size, fmin, fmax, center=False):
     if torch.min(y) < -1.:
@@ -76,21 +135,18 @@ def mel_spectrogram(y, n_fft, num_mels, sampling_rate, hop_size, win_size, fmin,
     if torch.max(y) > 1.:
         logging.warning('max value is {}'.format(torch.max(y)))
 
-    global mel_basis, hann_window
-    if fmax not in mel_basis:
-        mel = librosa_mel_fn(sampling_rate, n_fft, num_mels, fmin, fmax)
-        mel_basis[str(fmax)+'_'+str(y.device)] = torch.from_numpy(mel).float().to(y.device)
-        hann_window[str(y.device)] = torch.hann_window(win_size).to(y.device)
+    mel = get_mel_basis(sampling_rate, n_fft, num_mels, fmin, fmax, y.device, y.dtype)
+    window = get_hann_window(win_size, y.device, y.dtype)
 
     y = torch.nn.functional.pad(y.unsqueeze(1), (int((n_fft-hop_size)/2), int((n_fft-hop_size)/2)), mode='reflect')
     y = y.squeeze(1)
 
-    spec = torch.stft(y, n_fft, hop_length=hop_size, win_length=win_size, window=hann_window[str(y.device)],
+    spec = torch.stft(y, n_fft, hop_length=hop_size, win_length=win_size, window=window,
                       center=center, pad_mode='reflect', normalized=False, onesided=True, return_complex=False)
 
     spec = torch.sqrt(spec.pow(2).sum(-1)+(1e-9))
 
-    spec = torch.matmul(mel_basis[str(fmax)+'_'+str(y.device)], spec)
+    spec = torch.matmul(mel, spec)
     spec = spectral_normalize_torch(spec)
 
     return spec
@@ -101,13 +157,12 @@ def cepstral_liftering(y, n_fft, feature_size, hop_size, win_size, cutoff= 3, ce
     if torch.max(y) > 1.:
         logging.warning('max value is {}'.format(torch.max(y)))
 
-    global hann_window
-    hann_window[str(y.device)] = torch.hann_window(win_size).to(y.device)
+    window = get_hann_window(win_size, y.device, y.dtype)
 
     y = torch.nn.functional.pad(y.unsqueeze(1), (int((n_fft-hop_size)/2), int((n_fft-hop_size)/2)), mode='reflect')
     y = y.squeeze(1)
 
-    spec = torch.stft(y, n_fft, hop_length=hop_size, win_length=win_size, window=hann_window[str(y.device)],
+    spec = torch.stft(y, n_fft, hop_length=hop_size, win_length=win_size, window=window,
                       center=center, pad_mode='reflect', normalized=False, onesided=True, return_complex= True)
     spec = torch.fft.irfft(torch.log(spec+1e-6), axis= 1)
     
@@ -129,13 +184,12 @@ def spectrogram(y, n_fft, hop_size, win_size, center=False):
     if torch.max(y) > 1.:
         logging.warning('max value is {}'.format(torch.max(y)))
 
-    global hann_window
-    hann_window[str(y.device)] = torch.hann_window(win_size).to(y.device)
+    window = get_hann_window(win_size, y.device, y.dtype)
 
     y = torch.nn.functional.pad(y.unsqueeze(1), (int((n_fft-hop_size)/2), int((n_fft-hop_size)/2)), mode='reflect')
     y = y.squeeze(1)
 
-    spec = torch.stft(y, n_fft, hop_length=hop_size, win_length=win_size, window=hann_window[str(y.device)],
+    spec = torch.stft(y, n_fft, hop_length=hop_size, win_length=win_size, window=window,
                       center=center, pad_mode='reflect', normalized=False, onesided=True, return_complex=False)
 
     spec = torch.sqrt(spec.pow(2).sum(-1)+(1e-9))
@@ -146,13 +200,9 @@ def spectrogram(y, n_fft, hop_size, win_size, center=False):
 def spectrogram_to_mel(spec, n_fft, num_mels, sampling_rate, win_size, fmin, fmax, use_denorm= False):
     spec = spectral_de_normalize_torch(spec) if use_denorm else spec
     
-    global mel_basis, hann_window
-    if fmax not in mel_basis:
-        mel = librosa_mel_fn(sampling_rate, n_fft, num_mels, fmin, fmax)
-        mel_basis[str(fmax)+'_'+str(spec.device)] = torch.from_numpy(mel).float().to(spec.device)
-        hann_window[str(spec.device)] = torch.hann_window(win_size).to(spec.device)
+    mel = get_mel_basis(sampling_rate, n_fft, num_mels, fmin, fmax, spec.device, spec.dtype)
 
-    spec = torch.matmul(mel_basis[str(fmax)+'_'+str(spec.device)], spec)
+    spec = torch.matmul(mel, spec)
     spec = spectral_normalize_torch(spec)
 
     return spec
@@ -163,19 +213,99 @@ def spec_energy(y, n_fft, hop_size, win_size, center=False):
     if torch.max(y) > 1.:
         logging.warning('max value is {}'.format(torch.max(y)))
 
-    global hann_window
-    hann_window[str(y.device)] = torch.hann_window(win_size).to(y.device)
+    window = get_hann_window(win_size, y.device, y.dtype)
 
     y = torch.nn.functional.pad(y.unsqueeze(1), (int((n_fft-hop_size)/2), int((n_fft-hop_size)/2)), mode='reflect')
     y = y.squeeze(1)
 
-    spec = torch.stft(y, n_fft, hop_length=hop_size, win_length=win_size, window=hann_window[str(y.device)],
+    spec = torch.stft(y, n_fft, hop_length=hop_size, win_length=win_size, window=window,
                       center=center, pad_mode='reflect', normalized=False, onesided=True, return_complex=False)
     spec = torch.sqrt(spec.pow(2).sum(-1)+(1e-9))
     energy = torch.norm(spec, dim= 1)
 
     return energy
 
+def stft_magnitude(y, n_fft, hop_size, win_size, center=False, pad=True):
+    window = get_hann_window(win_size, y.device, y.dtype)
+
+    if pad:
+        y = torch.nn.functional.pad(y.unsqueeze(1), (int((n_fft-hop_size)/2), int((n_fft-hop_size)/2)), mode='reflect')
+        y = y.squeeze(1)
+
+    spec = torch.stft(y, n_fft, hop_length=hop_size, win_length=win_size, window=window,
+                      center=center, pad_mode='reflect', normalized=False, onesided=True, return_complex=False)
+
+    return torch.sqrt(spec.pow(2).sum(-1)+(1e-9))
+
+def spectrogram_mel_energy(y, n_fft, num_mels, sampling_rate, hop_size, win_size, fmin, fmax, center=False):
+    '''
+    y: [Batch, Time]
+    The fused extractor of spectrogram, mel_spectrogram and spec_energy.
+    The magnitude is computed by one STFT and the three features are derived from it.
+    Returns the spectrogram [Batch, N_FFT // 2 + 1, Frame], the mel [Batch, Num_Mels, Frame] and the energy [Batch, Frame].
+    '''
+    if torch.min(y) < -1.:
+        logging.warning('min value is {}'.format(torch.min(y)))
+    if torch.max(y) > 1.:
+        logging.warning('max value is {}'.format(torch.max(y)))
+
+    mel_filter = get_mel_basis(sampling_rate, n_fft, num_mels, fmin, fmax, y.device, y.dtype)
+
+    magnitude = stft_magnitude(y, n_fft, hop_size, win_size, center)
+
+    spec = spectral_normalize_torch(magnitude)
+    mel = spectral_normalize_torch(torch.matmul(mel_filter, magnitude))
+    energy = torch.norm(magnitude, dim= 1)
+
+    return spec, mel, energy
+
+def spectrogram_mel_energy_batch(ys, n_fft, num_mels, sampling_rate, hop_size, win_size, fmin, fmax, max_batch_samples=2 ** 22, device='cpu'):
+    '''
+    ys: a list of 1D audios (numpy or torch) with different lengths.
+    The audios are sorted by the length and grouped to the batches of at most max_batch_samples padded samples.
+    Each audio is reflect-padded like spectrogram_mel_energy and then the batch is zero-padded, so the frames of an audio
+    never see the zero padding and are same to the single extraction.
+    Returns the lists of the spectrograms [N_FFT // 2 + 1, Frame], the mels [Num_Mels, Frame] and the energies [Frame] in the order of ys on cpu.
+    '''
+    padding = int((n_fft-hop_size)/2)
+    ys = [torch.as_tensor(y, dtype=torch.float32) for y in ys]
+
+    batches, batch = [], []
+    for index in sorted(range(len(ys)), key=lambda x: ys[x].size(0)):
+        if len(batch) > 0 and (len(batch) + 1) * (ys[index].size(0) + 2 * padding) > max_batch_samples:
+            batches.append(batch)
+            batch = []
+        batch.append(index)
+    if len(batch) > 0:
+        batches.append(batch)
+
+    specs, mels, energies = [None] * len(ys), [None] * len(ys), [None] * len(ys)
+    for batch in batches:
+        y_batch = [
+            torch.nn.functional.pad(ys[index].view(1, 1, -1), (padding, padding), mode='reflect').view(-1)
+            for index in batch
+            ]
+        frame_counts = [(y.size(0) - n_fft) // hop_size + 1 for y in y_batch]
+        y_batch = torch.nn.utils.rnn.pad_sequence(y_batch, batch_first=True).to(device)
+        if torch.min(y_batch) < -1.:
+            logging.warning('min value is {}'.format(torch.min(y_batch)))
+        if torch.max(y_batch) > 1.:
+            logging.warning('max value is {}'.format(torch.max(y_batch)))
+
+        mel_filter = get_mel_basis(sampling_rate, n_fft, num_mels, fmin, fmax, y_batch.device, y_batch.dtype)
+
+        magnitude = stft_magnitude(y_batch, n_fft, hop_size, win_size, center=False, pad=False)
+        spec = spectral_normalize_torch(magnitude).cpu()
+        mel = spectral_normalize_torch(torch.matmul(mel_filter, magnitude)).cpu()
+        energy = torch.norm(magnitude, dim= 1).cpu()
+
+        for batch_index, (index, frame_count) in enumerate(zip(batch, frame_counts)):
+            specs[index] = spec[batch_index, :, :frame_count]
+            mels[index] = mel[batch_index, :, :frame_count]
+            energies[index] = energy[batch_index, :frame_count]
+
+    return specs, mels, energies
+
 def get_dataset_filelist(a):
     with open(a.input_training_file, 'r', encoding='utf-8') as fi:
         training_files = [os.path.join(a.input_wavs_dir, x.split('|')[0] + '.wav')
@@ -203,39 +333,71 @@ def get_frequency_warp(n_fft: int, sampling_rate: int, fhi: int= 4800, alpha: fl
     
     return frequency_warp
 
+def get_frequency_warp_matrix(n_fft: int, sampling_rate: int, alpha: float, device, dtype=torch.float32):
+    '''
+    n_fft: the frequency bins of the spectrogram.
+    Returns the linear interpolation matrix [Bin, Bin] of the frequency warp. Each bin except both edges is split
+    to the two nearest warped bins, and warp_matrix @ spec is the warped spectrogram.
+    '''
+    def generate():
+        frequency_warp = get_frequency_warp(n_fft= n_fft, sampling_rate= sampling_rate, alpha= alpha)
+        frequency_warp *= (n_fft - 1) / frequency_warp.max()
+
+        indices = torch.arange(1, n_fft - 1)
+        positions = frequency_warp[indices].floor().long().clamp(max= n_fft - 2)
+        warp_up = frequency_warp[indices] - positions
+        warp_down = 1 - warp_up
+
+        warp_matrix = torch.zeros(n_fft, n_fft)
+        warp_matrix[0, 0] = 1.0
+        warp_matrix[n_fft - 1, n_fft - 1] = 1.0
+        warp_matrix.index_put_((positions, indices), warp_down, accumulate= True)
+        warp_matrix.index_put_((positions + 1, indices), warp_up, accumulate= True)
+
+        return warp_matrix.to(device= device, dtype= dtype)
+
+    device = torch.device(device)
+    return _cached(
+        frequency_warp_matrix,
+        (n_fft, sampling_rate, float(alpha), str(device), dtype),
+        generate,
+        max_size= frequency_warp_matrix_max_size
+        )
+
 # https://github.com/biggytruck/SpeechSplit2/blob/b67354aa74b252003c8e644176fc964ad1a241ad/utils.py#L252
-def vtlp(y: torch.Tensor, n_fft: int, sampling_rate: int, hop_size: int, win_size: int, alpha: float, center: bool=False):
+def vtlp(y: torch.Tensor, n_fft: int, sampling_rate: int, hop_size: int, win_size: int, alpha, center: bool=False):
+    '''
+    y: [Batch, Time]
+    alpha: a float for all audios, or a list or tensor [Batch] of the alphas of each audio.
+    '''
     if torch.min(y) < -1.:
         logging.warning('min value is {}'.format(torch.min(y)))
     if torch.max(y) > 1.:
         logging.warning('max value is {}'.format(torch.max(y)))
 
-    global hann_window
-    hann_window[str(y.device)] = torch.hann_window(win_size).to(y.device)
+    window = get_hann_window(win_size, y.device, y.dtype)
 
     y_padded = torch.nn.functional.pad(y.unsqueeze(1), (int((n_fft-hop_size)/2), int((n_fft-hop_size)/2)), mode='reflect')
     y_padded = y_padded.squeeze(1)
 
-    spec = torch.stft(y_padded, n_fft, hop_length=hop_size, win_length=win_size, window=hann_window[str(y_padded.device)],
+    spec = torch.stft(y_padded, n_fft, hop_length=hop_size, win_length=win_size, window=window,
                       center=center, pad_mode='reflect', normalized=False, onesided=True, return_complex= True)
 
-    frequency_warp = get_frequency_warp(n_fft= spec.size(1), sampling_rate= sampling_rate, alpha= alpha)
-    frequency_warp *= (spec.size(1) - 1) / frequency_warp.max()
-    
-    spec_warp = torch.zeros_like(spec)
-    for index in range(spec.size(1)):
-        if index == 0 or index == spec.size(1) - 1:
-            spec_warp[:, index] += spec[:, index]
-        else:
-            warp_up = frequency_warp[index] - frequency_warp[index].floor()
-            warp_down = 1 - warp_up
-            position = int(frequency_warp[index].floor())
-            spec_warp[:, position] += warp_down * spec[:, index]
-            spec_warp[:, position + 1] += warp_up * spec[:, index]
+    if isinstance(alpha, (list, tuple, torch.Tensor, np.ndarray)):
+        warp_matrix = torch.stack([
+            get_frequency_warp_matrix(spec.size(1), sampling_rate, float(x), y.device, y.dtype)
+            for x in alpha
+            ])  # [Batch, Bin, Bin]
+    else:
+        warp_matrix = get_frequency_warp_matrix(spec.size(1), sampling_rate, alpha, y.device, y.dtype)  # [Bin, Bin]
+
+    spec_warp = torch.view_as_real(spec)    # [Batch, Bin, Frame, 2]
+    spec_warp = torch.matmul(warp_matrix, spec_warp.reshape(spec.size(0), spec.size(1), -1))
+    spec_warp = torch.view_as_complex(spec_warp.view(spec.size(0), spec.size(1), spec.size(2), 2))
 
-    y_warp = torch.istft(spec_warp, n_fft= n_fft, hop_length= hop_size, win_length= win_size, window=hann_window[str(y_padded.device)])
+    y_warp = torch.istft(spec_warp, n_fft= n_fft, hop_length= hop_size, win_length= win_size, window=window)
     y_warp = torch.nn.functional.pad(y_warp.unsqueeze(1), (0, y.size(1) - y_warp.size(1))).squeeze(1)
-    y_warp = np.clip(y_warp, -1.0, 1.0)
+    y_warp = torch.clamp(y_warp, -1.0, 1.0)
 
     return y_warp
 